@@ -13,6 +13,11 @@ class Dfp(Plugin):
             "dfp_selfserve_salesperson_id",
             "dfp_selfserve_trafficker_id",
             "dfp_selfserve_template_id",
+            "dfp_requests_per_second",
+            "dfp_backfill_requests_per_second",
+        ],
+        ConfigValue.float: [
+            "dfp_profile_sample_rate",
         ],
         ConfigValue.str: [
             "dfp_project_id",
@@ -20,6 +25,11 @@ class Dfp(Plugin):
             "dfp_service_account_email",
             "dfp_cert_fingerprint",
             "dfp_service_version",
+            "dfp_timezone_id",
+            "dfp_ratelimit_backend",
+            "dfp_wsdl_cache_dir",
+            "dfp_targeting_file",
+            "dfp_outbox_dir",
         ],
     }
 
@@ -32,6 +42,7 @@ class Dfp(Plugin):
 
     def add_routes(self, mc):
         mc("/api/dfp/link", controller="link", action="link_from_id")
+        mc("/api/dfp/links", controller="link", action="links_from_ids")
 
     def load_controllers(self):
         from reddit_dfp.controllers.linkcontroller import LinkController
@@ -0,0 +1,167 @@
+"""
+Backfill of existing promoted links and campaigns into DFP.
+
+Syncing is hook driven, so only things edited since the plugin was
+installed reach DFP by themselves. This walks promoted campaigns in id
+order, a page at a time, and syncs each page through the list based
+calls: the owners' companies and orders are resolved together, then the
+page's creatives and lineitems are created (or updated) and associated
+in a handful of calls. Run it with:
+
+    paster run run.ini -c "from reddit_dfp import backfill; backfill.run()"
+
+The last campaign synced is checkpointed in DfpSyncState after every
+page, so an interrupted run picks up where it left off. Campaigns that
+fail are logged by id and counted but don't hold the checkpoint back.
+Pages are paced to `dfp_backfill_requests_per_second` DFP calls, on top
+of the shared rate limit, to leave room for the live sync.
+"""
+
+import time
+
+from collections import Counter
+from datetime import datetime
+from pylons import g
+
+from r2.lib.db.operators import asc
+from r2.lib.utils import fetch_things2
+from r2.models import (
+    Account,
+    Link,
+    PromoCampaign,
+)
+
+from reddit_dfp.lib import (
+    instrument,
+    pql,
+)
+from reddit_dfp.models.cache import DfpSyncState
+from reddit_dfp.services import (
+    creatives_service,
+    lineitems_service,
+    orders_service,
+)
+
+PAGE_SIZE = pql.PAGE_LIMIT
+CHECKPOINT = "backfill_campaigns"
+DEFAULT_REQUESTS_PER_SECOND = 4
+
+
+def _get_rate():
+    return (getattr(g, "dfp_backfill_requests_per_second", None) or
+            DEFAULT_REQUESTS_PER_SECOND)
+
+
+def _iter_pages(after, include_ended):
+    conditions = [PromoCampaign.c._id > after]
+
+    if not include_ended:
+        conditions.append(PromoCampaign.c.end_date > datetime.now(g.tz))
+
+    query = PromoCampaign._query(*conditions, sort=asc("_id"), data=True)
+
+    return fetch_things2(query, chunk_size=PAGE_SIZE, chunks=True)
+
+
+def _sync_campaigns(campaigns):
+    counts = Counter()
+    links = Link._byID({campaign.link_id for campaign in campaigns},
+                       data=True, return_dict=True)
+    live = [campaign for campaign in campaigns
+                if campaign.link_id in links and
+                    not links[campaign.link_id]._deleted]
+    counts["skipped"] += len(campaigns) - len(live)
+
+    campaigns = live
+    links = {campaign.link_id: links[campaign.link_id]
+                for campaign in campaigns}
+
+    if not campaigns:
+        return counts
+
+    owners = Account._byID(
+        {campaign.owner_id for campaign in campaigns} |
+        {link.author_id for link in links.itervalues()},
+        data=True, return_dict=True)
+
+    # resolved together up front so the per owner lookups below all hit
+    # the account cache
+    orders_service.upsert_orders(owners.values())
+
+    creatives = creatives_service.upsert_creatives(
+        [(owners[link.author_id], link) for link in links.itervalues()])
+    lineitems = lineitems_service.upsert_lineitems(
+        [(owners[campaign.owner_id], campaign) for campaign in campaigns])
+
+    lineitems_service.associate_with_creatives(
+        [(lineitems[campaign._fullname],
+          creatives[links[campaign.link_id]._fullname])
+            for campaign in campaigns])
+
+    counts["links"] += len(links)
+    counts["campaigns"] += len(campaigns)
+
+    return counts
+
+
+def _sync_page(campaigns, counts):
+    """
+    Syncs a page of campaigns together, falling back to one at a time if
+    that fails so a bad campaign only fails itself. Failures are counted
+    and logged rather than raised, so the checkpoint can move past them.
+    """
+
+    try:
+        counts.update(_sync_campaigns(campaigns))
+        return
+    except Exception as e:
+        g.log.warning("dfp backfill: page failed, syncing its campaigns "
+                      "one at a time: %r" % e)
+
+    for campaign in campaigns:
+        try:
+            counts.update(_sync_campaigns([campaign]))
+        except Exception as e:
+            counts["failed"] += 1
+            g.log.error("dfp backfill: failed to sync campaign %d: %r" %
+                        (campaign._id, e))
+
+
+def run(include_ended=False, restart=False, dry_run=False):
+    """
+    Syncs every promoted campaign (only those still running unless
+    `include_ended`) and its link, resuming from the last checkpoint
+    unless `restart`.
+    """
+
+    counts = Counter()
+    after = 0 if restart else int(DfpSyncState.get(CHECKPOINT) or 0)
+    rate = _get_rate()
+
+    if after:
+        g.log.info("dfp backfill: resuming after campaign %d" % after)
+
+    for campaigns in _iter_pages(after, include_ended):
+        start = time.time()
+
+        if dry_run:
+            counts["campaigns"] += len(campaigns)
+            continue
+
+        with instrument.counting() as counter:
+            _sync_page(campaigns, counts)
+
+        counts["api_calls"] += counter.calls
+        DfpSyncState.set(CHECKPOINT, str(campaigns[-1]._id))
+
+        g.log.info("dfp backfill: synced through campaign %d: %s" %
+                   (campaigns[-1]._id, dict(counts)))
+
+        # pace pages to the backfill's share of the rate limit
+        wait = float(counter.calls) / rate - (time.time() - start)
+        if wait > 0:
+            time.sleep(wait)
+
+    g.log.info("dfp backfill: done: %s" % dict(counts))
+
+    return counts
@@ -0,0 +1,216 @@
+"""
+Throughput benchmark of the `dfp_q` handlers against a fake DFP.
+
+Replays a synthetic stream of upsert_promotion, upsert_campaign and
+deactivate_campaign messages for recent campaigns through the same
+coalescing and dispatch the batched consumer uses, with every DFP service
+swapped for a `FakeDfp`. Run it against a dev install with:
+
+    paster run run.ini -c "from reddit_dfp import benchmark; benchmark.run()"
+
+Nothing is sent to DFP, and the ids the fake hands out are kept in
+memory (see `MemoryIdStore`) rather than recorded on the links, accounts
+and id map, so the real ids are left alone.
+"""
+
+import random
+import time
+
+from multiprocessing.pool import ThreadPool
+from pylons import g
+
+from r2.lib.db.operators import desc
+from r2.models import (
+    Link,
+    PromoCampaign,
+)
+
+from reddit_dfp import queue
+from reddit_dfp.lib import (
+    pql,
+    tasks,
+)
+from reddit_dfp.models import cache
+from reddit_dfp.services.fake_dfp import FakeDfp
+
+# relative frequency of each action in the synthetic stream
+ACTION_MIX = (
+    ("upsert_promotion", 3),
+    ("upsert_campaign", 6),
+    ("deactivate_campaign", 1),
+)
+PERCENTILES = (50, 90, 99)
+
+
+class MemoryIdStore(cache.IdStore):
+    """
+    Keeps the DFP ids written during a run (thing attributes, the id map
+    and known associations) in memory and hides the real ones, so a sync
+    against a fake DFP leaves nothing behind.
+    """
+
+    def __init__(self):
+        super(MemoryIdStore, self).__init__()
+        # (fullname, attr) -> dfp id
+        self._attrs = {}
+        # fullname -> DfpIdsByFullname columns
+        self._columns = {}
+        self._flags = set()
+
+    def get_attr(self, thing, attr):
+        return self._attrs.get((thing._fullname, attr))
+
+    def set_attr(self, thing, attr, dfp_id):
+        self._attrs[(thing._fullname, attr)] = dfp_id
+
+    def get_row(self, fullname, fresh=False):
+        return self._columns.get(fullname, {})
+
+    def update_row(self, fullname, columns):
+        self._columns[fullname] = dict(self.get_row(fullname), **columns)
+
+    def remove_columns(self, fullname, columns):
+        self._columns[fullname] = {
+            column: value
+                for column, value in self.get_row(fullname).iteritems()
+                if column not in columns}
+
+    def get_flags(self, keys):
+        return {key for key in keys if key in self._flags}
+
+    def set_flags(self, keys, time):
+        self._flags.update(keys)
+
+
+def _get_campaigns(count):
+    campaigns = list(PromoCampaign._query(
+        sort=desc("_date"), limit=count, data=True))
+    links = Link._byID({campaign.link_id for campaign in campaigns},
+                       data=True, return_dict=True)
+
+    return [(links[campaign.link_id], campaign) for campaign in campaigns
+                if campaign.link_id in links]
+
+
+def make_stream(pairs, count, mix=ACTION_MIX, seed=None):
+    """
+    Returns `count` random (action, payload) messages for a list of
+    (link, campaign) pairs.
+    """
+
+    rand = random.Random(seed)
+    actions = sum([[action] * weight for action, weight in mix], [])
+    stream = []
+
+    for i in xrange(count):
+        action = rand.choice(actions)
+        link, campaign = rand.choice(pairs)
+        payload = {"link": link._fullname}
+
+        if action != "upsert_promotion":
+            payload["campaign"] = campaign._fullname
+
+        stream.append((action, payload))
+
+    return stream
+
+
+def _percentile(values, percent):
+    if not values:
+        return None
+
+    index = int(round((len(values) - 1) * percent / 100.0))
+
+    return sorted(values)[index]
+
+
+def replay(stream, batch_size=queue.BATCH_SIZE, workers=1):
+    """
+    Dispatches a stream of (action, payload) messages `batch_size` at a
+    time and returns (latencies, failures): the time each message spent in
+    its batch and the number of messages whose handlers failed.
+    """
+
+    processor = queue._get_processor()
+    pool = ThreadPool(workers) if workers > 1 else None
+    latencies = []
+    failures = 0
+
+    for batch in pql.chunks(stream, batch_size):
+        start = time.time()
+
+        survivors = queue.coalesce(batch)
+        messages = [(None, action, payload,
+                        {"action": action, "payload": payload})
+                    for action, payload in (batch[i] for i in survivors)]
+
+        if pool:
+            dispatch = tasks.with_context(
+                lambda messages: queue._dispatch(processor, messages))
+            outcomes = sum(pool.map(
+                dispatch, queue._partition(messages, workers)), [])
+        else:
+            outcomes = queue._dispatch(processor, messages)
+
+        failures += sum(1 for item, data, e in outcomes if e)
+        latencies.extend([time.time() - start] * len(batch))
+
+    if pool:
+        pool.close()
+
+    return latencies, failures
+
+
+def run(messages=1000, campaigns=100, batch_size=queue.BATCH_SIZE,
+        workers=1, latency=0.05, jitter=0.02, quota=None, error_rate=0,
+        seed=None):
+    """
+    Benchmarks `messages` synthetic messages spread over the `campaigns`
+    most recent campaigns and returns (and logs) the results.
+
+    `latency`, `jitter`, `quota` and `error_rate` are passed on to the
+    `FakeDfp`.
+    """
+
+    pairs = _get_campaigns(campaigns)
+    if not pairs:
+        raise ValueError("no promoted campaigns to benchmark with")
+
+    stream = make_stream(pairs, messages, seed=seed)
+
+    fake = FakeDfp(latency=latency, jitter=jitter, quota=quota,
+                   error_rate=error_rate)
+    fake.install()
+    # starts from nothing synced, like the fake
+    cache.set_id_store(MemoryIdStore())
+    try:
+        start = time.time()
+        latencies, failures = replay(
+            stream, batch_size=batch_size, workers=workers)
+        elapsed = time.time() - start
+    finally:
+        cache.set_id_store(None)
+        fake.uninstall()
+
+    api_calls = sum(fake.calls.itervalues())
+    results = {
+        "messages": len(stream),
+        "failures": failures,
+        "seconds": elapsed,
+        "messages_per_second": len(stream) / elapsed,
+        "api_calls": api_calls,
+        "api_calls_per_message": float(api_calls) / len(stream),
+        "calls": dict(fake.calls),
+        "faults": dict(fake.faults),
+    }
+    for percent in PERCENTILES:
+        results["p%d_ms" % percent] = (
+            _percentile(latencies, percent) * 1000)
+
+    g.log.info("dfp benchmark: %d messages in %.1fs, %.1f messages/s, "
+               "%.2f api calls/message, p50 %.0fms, p90 %.0fms, p99 %.0fms" %
+               (results["messages"], elapsed, results["messages_per_second"],
+                results["api_calls_per_message"], results["p50_ms"],
+                results["p90_ms"], results["p99_ms"]))
+
+    return results
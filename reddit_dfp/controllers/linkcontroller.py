@@ -1,4 +1,5 @@
-from pylons import g
+from pylons import c, g
+from suds import WebFault
 
 from r2.controllers import add_controller
 from r2.controllers.api import ApiController
@@ -7,6 +8,7 @@ from r2.lib.base import abort
 from r2.lib.errors import errors
 from r2.lib.validator import (
     json_validate,
+    Validator,
     VInt,
     VModhashIfLoggedIn,
 )
@@ -19,9 +21,33 @@ from r2.lib.pages.things import (
     wrap_links,
 )
 
-from reddit_dfp.models.cache import LinksByExternalId
+from reddit_dfp.lib import retry
+from reddit_dfp.models.cache import (
+    LinksByExternalId,
+    RenderedLinks,
+)
 from reddit_dfp.services import creatives_service
 
+MAX_EXTERNAL_IDS = 25
+
+
+class VExternalIds(Validator):
+    def run(self, value):
+        try:
+            external_ids = [int(i) for i in (value or "").split(",") if i]
+        except ValueError:
+            self.set_error(errors.BAD_NUMBER)
+            return
+
+        if (not external_ids or len(external_ids) > MAX_EXTERNAL_IDS or
+                any(external_id < 0 for external_id in external_ids)):
+            self.set_error(errors.BAD_NUMBER)
+            return
+
+        # preserve the order the ids were asked for, minus duplicates
+        return sorted(set(external_ids), key=external_ids.index)
+
+
 def _get_subreddit():
     return Subreddit._byID(Subreddit.get_promote_srid())
 
@@ -74,9 +100,90 @@ def _create_link(creative):
     link.external_id = creative["id"]
 
     link._commit()
+    RenderedLinks.invalidate(link)
+
     return link
 
 
+def _fetch_creatives(external_ids):
+    try:
+        # never sleep on dfp in a web request
+        with retry.deferring():
+            return creatives_service.by_ids(external_ids)
+    except retry.RetryLater as e:
+        g.log.warning("dfp unavailable for creatives %s: %r" %
+                      (external_ids, e.cause))
+        abort(503)
+    except WebFault:
+        # transient faults were raised as RetryLater, so dfp rejected the
+        # ids outright
+        return {}
+
+
+def _add_link(external_id, creative):
+    # only one request creates the link for a new external_id, everyone
+    # else waits for it and then finds the link.
+    with g.make_lock("dfp_link", "dfp_link_create-%s" % external_id):
+        link = LinksByExternalId.get(external_id)
+
+        if link:
+            return link
+
+        link = _create_link(creative)
+
+        LinksByExternalId.add(link)
+
+    return link
+
+
+def _get_or_create_links(external_ids):
+    links = LinksByExternalId.get_multi(external_ids)
+
+    unknown = [external_id for external_id in external_ids
+                if external_id not in links]
+    missing = LinksByExternalId.get_missing(unknown)
+    unknown = [external_id for external_id in unknown
+                if external_id not in missing]
+
+    if unknown:
+        creatives = _fetch_creatives(unknown)
+
+        for external_id in unknown:
+            creative = creatives.get(external_id)
+
+            if creative:
+                links[external_id] = _add_link(external_id, creative)
+            else:
+                LinksByExternalId.set_missing(external_id)
+
+    return links
+
+
+def _get_or_create_link(external_id):
+    return _get_or_create_links([external_id]).get(external_id)
+
+
+def _render_link(link):
+    # renderings for logged in users include their votes etc.
+    cacheable = not c.user_is_loggedin
+    context = (c.render_style, c.lang)
+
+    if cacheable:
+        rendered = RenderedLinks.get(link, *context)
+
+        if rendered is not None:
+            return rendered
+
+    listing = wrap_links(link)
+    thing = listing.things[0]
+    rendered = thing.render()
+
+    if cacheable:
+        RenderedLinks.set(link, rendered, *context)
+
+    return rendered
+
+
 @add_controller
 class LinkController(ApiController):
     @json_validate(
@@ -87,23 +194,25 @@ class LinkController(ApiController):
         if (responder.has_errors("external_id", errors.BAD_NUMBER)):
             return
 
-        link = LinksByExternalId.get(external_id)
+        link = _get_or_create_link(external_id)
 
         if not link:
-            try:
-                creative = creatives_service.by_id(external_id)
-            except:
-                creative = None
+            abort(404)
 
-            if not creative:
-                abort(404)
+        return _render_link(link)
 
-            link = _create_link(creative)
 
-            LinksByExternalId.add(link)
-
-        listing = wrap_links(link)
-        thing = listing.things[0]
+    @json_validate(
+        VModhashIfLoggedIn(),
+        external_ids=VExternalIds("external_ids"),
+    )
+    def POST_links_from_ids(self, responder, external_ids, *a, **kw):
+        if (responder.has_errors("external_ids", errors.BAD_NUMBER)):
+            return
 
-        return thing.render()
+        links = _get_or_create_links(external_ids)
 
+        return {
+            str(external_id): _render_link(links[external_id])
+                for external_id in external_ids if external_id in links
+        }
@@ -1,99 +1,198 @@
-import csv
+"""
+Imports DFP's geo and operating system targeting ids.
+
+The import only runs on demand, typically when deploying:
+
+    paster run run.ini -c "from reddit_dfp.data import targeting; targeting.import_targeting()"
+
+It writes a json table of the results, plus a memory mapped index of it
+(see `targeting_index`) that servers look ids up in instead of querying
+DFP themselves.
+"""
+
+import json
+import os
 import tempfile
 
-from googleads import dfp
+from os import path
 from pylons import g
 
 from reddit_dfp.data.states import state_abbreviations
+from reddit_dfp.data.targeting_index import (
+    geo_code,
+    os_code,
+    TargetingIndex,
+    write_index,
+)
+from reddit_dfp.lib import pql
+from reddit_dfp.lib.lru import LRUCache
 from reddit_dfp.services import authentication_service
 
-dfp_client = authentication_service.get_client()
-dfp_report_downloader = dfp_client.GetDataDownloader(version=g.dfp_service_version)
+TARGETING_FILE = path.join(path.dirname(path.abspath(__file__)),
+                           "targeting.json")
+
+# DMA regions' geo target ids are their nielsen code offset by this
+DMA_ID_OFFSET = 200000
+
+GEO_QUERY = ("SELECT Id, Name, CanonicalParentId, CountryCode, Type "
+             "FROM Geo_Target "
+             "WHERE targetable = true AND "
+             "(type = 'Country' OR "
+             "(CountryCode = 'US' AND type IN ('State', 'DMA_Region')))")
+OS_QUERY = "SELECT Id, OperatingSystemName FROM Operating_System"
+
+# reddit's mobile_os choices -> DFP's OperatingSystemName for them
+MOBILE_OS_NAMES = {
+    "Android": "Android",
+    "iOS": "iOS",
+}
+
+LOOKUP_CACHE_SIZE = 5000
+
+_index = None
+_lookups = LRUCache(LOOKUP_CACHE_SIZE)
+
+
+def _get_targeting_file():
+    return getattr(g, "dfp_targeting_file", None) or TARGETING_FILE
+
+
+def _get_index_file(targeting_file=None):
+    return (targeting_file or _get_targeting_file()) + ".idx"
+
+
+def _iter_pql(query):
+    pql_service = authentication_service.get_service(
+        "PublisherQueryLanguageService")
+
+    return pql.iter_rows(pql_service.select, query)
+
+
+def _parse_geos(rows):
+    countries = {}
+    # dfp id -> (country code, region code)
+    regions_by_id = {}
+    dmas = []
+
+    for row in rows:
+        row_type = row["Type"].upper()
+        name = row["Name"]
+        country_code = row["CountryCode"]
+        country = countries.setdefault(country_code, {
+            "regions": {},
+            "metros": {},
+        })
+
+        if row_type == "COUNTRY":
+            country["id"] = int(row["Id"])
+            country["name"] = name
+        elif row_type == "STATE":
+            region_code = state_abbreviations.get(name.lower())
+
+            if not region_code:
+                continue
 
+            region = country["regions"].setdefault(region_code, {
+                "metros": {},
+            })
+            region["id"] = int(row["Id"])
+            region["name"] = name
+            regions_by_id[region["id"]] = (country_code, region_code)
+        elif row_type == "DMA_REGION":
+            # DMAs can be listed before their parents, so file them after
+            dmas.append(row)
 
-def _download_geos():
-    tmp_geos = tempfile.NamedTemporaryFile(
-            prefix="geo_targets_", suffix=".csv", mode="w", delete=False)
+    for row in dmas:
+        dfp_id = int(row["Id"])
+        metro = {
+            "id": dfp_id,
+            "name": row["Name"],
+        }
+        metro_code = str(dfp_id - DMA_ID_OFFSET)
+        parent_id = int(row["CanonicalParentId"] or 0)
 
-    pql_query = ("SELECT Id, Name, CanonicalParentId, CountryCode, Type "
-                 "FROM Geo_Target "
-                 "WHERE targetable = true AND "
-                 "type = 'Country' OR "
-                 "(CountryCode = 'US' AND type IN ('State', 'DMA_Region'))")
+        if parent_id in regions_by_id:
+            country_code, region_code = regions_by_id[parent_id]
+            region = countries[country_code]["regions"][region_code]
+            region["metros"][metro_code] = metro
+        else:
+            countries[row["CountryCode"]]["metros"][metro_code] = metro
 
-    dfp_report_downloader.DownloadPqlResultToCsv(
-            pql_query, output_file)
-    output_file.close()
+    return countries
 
-    print ("Saved geo targets to... %s" % output_file.name)
 
-    return output_file
+def _parse_mobile_os(rows):
+    operating_systems = {row["OperatingSystemName"]: int(row["Id"])
+                            for row in rows}
+    unknown = set(MOBILE_OS_NAMES.values()) - set(operating_systems)
 
+    if unknown:
+        raise ValueError("dfp has no operating systems named: %s" %
+                         ", ".join(sorted(unknown)))
 
-def _download_mobile_os():
-    output_file = tempfile.NamedTemporaryFile(
-            prefix="os_targets_", suffix=".csv", mode="w", delete=False)
+    return operating_systems
 
-    pql_query = "SELECT Id, OperatingSystemName FROM Operating_System"
 
-    dfp_report_downloader.DownloadPqlResultToCsv(
-            pql_query, output_file)
-    output_file.close()
+def import_targeting(output=None):
+    """
+    Streams the targeting tables from DFP and saves the parsed result.
+    """
 
-    print ("Saved mobile os targets to... %s" % output_file.name)
+    output = output or _get_targeting_file()
+    targeting = {
+        "countries": _parse_geos(_iter_pql(GEO_QUERY)),
+        "mobile_os": _parse_mobile_os(_iter_pql(OS_QUERY)),
+    }
 
-    return output_file
+    # write then rename so readers never see a partial file
+    fd, tmp_path = tempfile.mkstemp(dir=path.dirname(output))
+    with os.fdopen(fd, "w") as f:
+        json.dump(targeting, f, separators=(",", ":"), sort_keys=True)
+    os.rename(tmp_path, output)
 
+    write_index(targeting, _get_index_file(output))
 
-def _parse_geos():
-    tmp_file = _download_geos()
-    parsed = {}
+    g.log.info("saved dfp targeting to %s" % output)
 
-    with open(tmp_file.name, "r") as csvfile:
-        next(csvfile, None)
-        reader = csv.DictReader(csvfile, [
-            "id",
-            "name",
-            "parent",
-            "country_code",
-            "type"
-        ])
+    return targeting
 
-        for row in reader:
-            row_type = row["type"].upper()
-            name = row["name"]
 
-            if row_type == "COUNTRY":
-                parsed[row["country_code"]] = {
-                    "name": name,
-                }
+def get_index():
+    """
+    Returns the memory mapped targeting index, opening it the first time.
+    """
 
-            if row_type == "STATE":
-                parent = row["parent"]
-                
-                if row["country_code"] == "US":
-                    country_us = gettattr(parsed, "US", {})
-                    regions_us = getattr(country_us, "regions", {})
-                    region_code = state_abbreviations[name.lower()]
-                    regions[region_code] = {
-                        "name": name,
-                        "metros": {},
-                    }
+    global _index
 
-                    parsed["US"] = country_us
-                else:
-                    continue
+    if _index is None:
+        _index = TargetingIndex(_get_index_file())
 
-            if row_type == "DMA_REGION":
+    return _index
 
 
+def _lookup(code):
+    dfp_id = _lookups.get(code)
 
+    if dfp_id is None:
+        dfp_id = get_index().get_id(code) or 0
+        _lookups.set(code, dfp_id)
 
+    return dfp_id or None
 
-temp_mobile_os = _download_mobile_os()
 
+def get_location_id(country, region=None, metro=None):
+    """
+    Returns the DFP geo target id for the most specific part of a location.
+    """
 
+    return _lookup(geo_code(country, region=region, metro=metro))
 
 
+def get_os_id(name):
+    """
+    Returns the DFP operating system id for one of reddit's mobile_os names.
+    """
 
+    dfp_name = MOBILE_OS_NAMES.get(name)
 
+    return _lookup(os_code(dfp_name)) if dfp_name else None
@@ -0,0 +1,156 @@
+"""
+A compact, memory mapped index of the imported targeting table.
+
+The file is a header followed by two sorted arrays of fixed width records:
+
+    codes: (code, dfp id)       sorted by code, for code -> id lookups
+    ids:   (dfp id, parent id)  sorted by id, for walking up the geo tree
+
+Workers mmap it read only, so every process on a host shares one copy in
+the page cache and lookups are binary searches that never build Python
+dicts of the whole table.
+"""
+
+import mmap
+import os
+import struct
+import tempfile
+
+from os import path
+
+MAGIC = "RDTI"
+VERSION = 1
+HEADER = struct.Struct("<4sIII")
+CODE_RECORD = struct.Struct("<32sQ")
+ID_RECORD = struct.Struct("<QQ")
+
+
+def geo_code(country, region=None, metro=None):
+    if metro:
+        return "geo:%s-DMA-%s" % (country, metro)
+    elif region:
+        return "geo:%s-%s" % (country, region)
+    else:
+        return "geo:%s" % country
+
+
+def os_code(name):
+    return "os:%s" % name
+
+
+def _iter_entries(targeting):
+    """
+    Yields (code, dfp id, parent id) for everything in a targeting table.
+    """
+
+    for country_code, country in targeting["countries"].iteritems():
+        country_id = country.get("id", 0)
+        if country_id:
+            yield geo_code(country_code), country_id, 0
+
+        for metro_code, metro in country["metros"].iteritems():
+            yield (geo_code(country_code, metro=metro_code), metro["id"],
+                   country_id)
+
+        for region_code, region in country["regions"].iteritems():
+            region_id = region.get("id", 0)
+            if region_id:
+                yield (geo_code(country_code, region=region_code), region_id,
+                       country_id)
+
+            for metro_code, metro in region["metros"].iteritems():
+                yield (geo_code(country_code, metro=metro_code), metro["id"],
+                       region_id or country_id)
+
+    for name, os_id in targeting["mobile_os"].iteritems():
+        yield os_code(name), os_id, 0
+
+
+def write_index(targeting, output):
+    entries = list(_iter_entries(targeting))
+    codes = sorted((code.encode("utf-8"), dfp_id)
+                    for code, dfp_id, parent_id in entries)
+    ids = sorted({(dfp_id, parent_id)
+                    for code, dfp_id, parent_id in entries})
+
+    for code, dfp_id in codes:
+        if len(code) > CODE_RECORD.size - 8:
+            raise ValueError("targeting code too long: %s" % code)
+
+    fd, tmp_path = tempfile.mkstemp(dir=path.dirname(output))
+    with os.fdopen(fd, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(codes), len(ids)))
+
+        for code, dfp_id in codes:
+            f.write(CODE_RECORD.pack(code, dfp_id))
+
+        for dfp_id, parent_id in ids:
+            f.write(ID_RECORD.pack(dfp_id, parent_id))
+
+    os.rename(tmp_path, output)
+
+
+class TargetingIndex(object):
+    def __init__(self, filename):
+        with open(filename, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self._num_codes, self._num_ids = (
+            HEADER.unpack_from(self._map, 0))
+
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s isn't a targeting index" % filename)
+
+        self._codes_offset = HEADER.size
+        self._ids_offset = (
+            self._codes_offset + self._num_codes * CODE_RECORD.size)
+
+    def _search(self, record, offset, count, key):
+        lo, hi = 0, count
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+            values = record.unpack_from(self._map, offset + mid * record.size)
+
+            if values[0] < key:
+                lo = mid + 1
+            elif values[0] > key:
+                hi = mid
+            else:
+                return values
+
+        return None
+
+    def get_id(self, code):
+        """
+        Returns the DFP id for a code made with `geo_code` or `os_code`.
+        """
+
+        key = code.encode("utf-8").ljust(CODE_RECORD.size - 8, "\0")
+        values = self._search(
+            CODE_RECORD, self._codes_offset, self._num_codes, key)
+
+        return values[1] if values else None
+
+    def get_parent(self, dfp_id):
+        values = self._search(
+            ID_RECORD, self._ids_offset, self._num_ids, dfp_id)
+
+        return (values[1] or None) if values else None
+
+    def get_parents(self, dfp_id):
+        """
+        Returns the chain of parent ids above `dfp_id`, nearest first.
+        """
+
+        parents = []
+        parent = self.get_parent(dfp_id)
+
+        while parent:
+            parents.append(parent)
+            parent = self.get_parent(parent)
+
+        return parents
+
+    def close(self):
+        self._map.close()
@@ -3,16 +3,14 @@ from r2.models import (
     Account,
 )
 
-from reddit_dfp import queue
-from reddit_dfp.services import lineitems_service
-from reddit_dfp.services import creatives_service
+from reddit_dfp import outbox
 
 hooks = HookRegistrar()
 
 @hooks.on("promote.new_promotion")
 @hooks.on("promote.edit_promotion")
 def upsert_promotion(link):
-    queue.push("upsert_promotion", {
+    outbox.add("upsert_promotion", {
         "link": link._fullname,
     })
 
@@ -20,7 +18,7 @@ def upsert_promotion(link):
 @hooks.on("promote.new_campaign")
 @hooks.on("promote.edit_campaign")
 def upsert_campaign(link, campaign):
-    queue.push("upsert_campaign", {
+    outbox.add("upsert_campaign", {
         "link": link._fullname,
         "campaign": campaign._fullname,
     })
@@ -28,7 +26,7 @@ def upsert_campaign(link, campaign):
 
 @hooks.on("promote.delete_campaign")
 def delete_campaign(link, campaign):
-    queue.push("deactivate_campaign", {
+    outbox.add("deactivate_campaign", {
         "link": link._fullname,
         "campaign": campaign._fullname,
     })
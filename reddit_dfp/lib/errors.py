@@ -1,2 +1,85 @@
+import socket
+import urllib2
+
+from suds import WebFault
+
+QUOTA_REASONS = {
+    "EXCEEDED_QUOTA",
+}
+# only reasons that mean the entity itself is gone, as opposed to a bad id
+# somewhere in the request (INVALID_ID), which forgetting can't fix
+NOT_FOUND_REASONS = {
+    "ENTITY_NOT_FOUND",
+    "NOT_FOUND",
+}
+TRANSIENT_REASONS = QUOTA_REASONS | {
+    "CONCURRENT_MODIFICATION",
+    "SERVER_ERROR",
+    "SERVER_BUSY",
+    "TRANSIENT_ERROR",
+    "UNEXPECTED_INTERNAL_API_ERROR",
+}
+
+
+def get_reasons(webfault):
+    try:
+        errors = webfault.fault.detail.ApiExceptionFault.errors
+    except AttributeError:
+        return []
+
+    if not isinstance(errors, list):
+        errors = [errors]
+
+    return [getattr(error, "reason", None) for error in errors]
+
+
 def get_reason(webfault):
-    return webfault.fault.detail.ApiExceptionFault.errors.reason
+    reasons = get_reasons(webfault)
+
+    return reasons[0] if reasons else None
+
+
+def is_quota_error(e):
+    return (isinstance(e, WebFault) and
+        any(reason in QUOTA_REASONS for reason in get_reasons(e)))
+
+
+def is_not_found(e):
+    return (isinstance(e, WebFault) and
+        any(reason in NOT_FOUND_REASONS for reason in get_reasons(e)))
+
+
+def is_transient(e):
+    """
+    Whether `e` is worth retrying: quota and server side faults or
+    connection problems, as opposed to validation errors that will fail
+    the same way every time.
+    """
+
+    if isinstance(e, WebFault):
+        return any(reason in TRANSIENT_REASONS for reason in get_reasons(e))
+
+    return isinstance(e, (socket.error, urllib2.URLError))
+
+
+def is_ambiguous(e):
+    """
+    Whether a write that failed with `e` may have been applied anyway: a
+    transient fault other than a quota one, which DFP rejects up front.
+    """
+
+    return is_transient(e) and not is_quota_error(e)
+
+
+def is_permanent(e):
+    """
+    Whether `e` will fail the same way however often it's retried: faults
+    other than transient or not found ones (resolving a missing entity
+    again can fix those) and errors about the data being synced, like an
+    archived lineitem or a link without a creative.
+    """
+
+    if is_transient(e) or is_not_found(e):
+        return False
+
+    return isinstance(e, (WebFault, ValueError, LookupError, IOError))
@@ -0,0 +1,42 @@
+import hashlib
+import json
+
+
+def fingerprint(obj):
+    """
+    Stable hash of a json-like structure, independent of key order.
+    """
+
+    serialized = json.dumps(obj, sort_keys=True, separators=(",", ":"),
+                            default=str)
+
+    return hashlib.sha1(serialized).hexdigest()
+
+
+def project(entity, template):
+    """
+    Returns the parts of `entity` (a dict or suds object) that `template`
+    has keys for, with leaf values as strings so that entities fetched
+    from DFP compare equal to the fields they were built from.
+    """
+
+    if entity is None:
+        return None
+
+    if isinstance(template, dict):
+        # xsi types only exist on the way in; suds doesn't expose them
+        return {
+            key: project(entity[key] if key in entity else None, value)
+                for key, value in template.iteritems()
+                if key != "xsi_type"
+        }
+
+    if isinstance(template, list):
+        if not template:
+            return [unicode(item) for item in entity]
+
+        last = len(template) - 1
+        return [project(item, template[min(i, last)])
+                    for i, item in enumerate(entity)]
+
+    return unicode(entity)
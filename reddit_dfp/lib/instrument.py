@@ -0,0 +1,206 @@
+"""
+Instrumentation of DFP API usage.
+
+Every service call is timed and counted in g.stats by service, method and
+outcome (success, quota, fault or error). Calls are also tallied for
+whatever `counting` block is active, so handlers can report how many
+calls each message cost, and into a process wide profile: per method
+totals plus a sample of the call stacks that led to them. Send a worker
+SIGUSR2 to have it write the profile to its log.
+"""
+
+import signal
+import threading
+import time
+import traceback
+
+from collections import Counter, defaultdict
+from os import path
+from pylons import g
+from suds import WebFault
+
+from reddit_dfp.lib import errors
+
+PROFILE_SAMPLE_RATE = 0.01
+PROFILE_STACK_DEPTH = 8
+PROFILE_TOP_STACKS = 20
+
+_local = threading.local()
+# reentrant since the dump signal's handler takes it on the main thread,
+# possibly while `_record` holds it there
+_profile_lock = threading.RLock()
+# (service, method, outcome) -> [calls, seconds, slowest]
+_profile = defaultdict(lambda: [0, 0., 0.])
+_stacks = Counter()
+_sampled = [0]
+
+_package_dir = path.dirname(path.dirname(path.abspath(__file__)))
+# plumbing every call passes through, left out of the sampled stacks
+_skipped_files = {path.join(_package_dir, "lib", "%s.py" % name)
+                    for name in ("instrument", "proxy", "retry")}
+
+
+class CallCounter(object):
+    """
+    Thread safe tally of API calls, shared with any pool threads started
+    (through `tasks.with_context`) while it's active.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def add(self):
+        with self._lock:
+            self.calls += 1
+
+
+class counting(object):
+    """
+    Context manager that counts the API calls made inside it, from this
+    thread or its pool threads, in `self.calls`.
+    """
+
+    def __init__(self, counter=None):
+        self.counter = counter or CallCounter()
+
+    @property
+    def calls(self):
+        return self.counter.calls
+
+    def __enter__(self):
+        self._previous = getattr(_local, "counter", None)
+        _local.counter = self.counter
+
+        return self
+
+    def __exit__(self, *exc_info):
+        _local.counter = self._previous
+
+        # nested blocks count towards the outer one too
+        if self._previous:
+            with self._previous._lock:
+                self._previous.calls += self.counter.calls
+
+
+def get_counter():
+    return getattr(_local, "counter", None)
+
+
+def _get_outcome(e):
+    if e is None:
+        return "success"
+    elif errors.is_quota_error(e):
+        return "quota"
+    elif isinstance(e, WebFault):
+        return "fault"
+    else:
+        return "error"
+
+
+def _get_sample_rate():
+    rate = getattr(g, "dfp_profile_sample_rate", None)
+
+    return PROFILE_SAMPLE_RATE if rate is None else rate
+
+
+def _sample_stack():
+    # the plugin's own frames, outermost first
+    frames = [frame for frame in traceback.extract_stack()
+                if frame[0].startswith(_package_dir) and
+                    frame[0] not in _skipped_files]
+
+    return tuple("%s:%d %s" % (path.relpath(filename, _package_dir),
+                               lineno, name)
+                    for filename, lineno, name, line
+                    in frames[-PROFILE_STACK_DEPTH:])
+
+
+def _record(service, method, outcome, elapsed):
+    g.stats.simple_event("dfp_api.%s.%s.%s" % (service, method, outcome))
+
+    counter = get_counter()
+    if counter:
+        counter.add()
+
+    with _profile_lock:
+        totals = _profile[(service, method, outcome)]
+        totals[0] += 1
+        totals[1] += elapsed
+        totals[2] = max(totals[2], elapsed)
+
+        _sampled[0] += _get_sample_rate()
+        if _sampled[0] < 1:
+            return
+        _sampled[0] -= 1
+
+    stack = _sample_stack()
+
+    with _profile_lock:
+        _stacks[stack] += 1
+
+
+def record_call(service, method, fn, *args, **kwargs):
+    """
+    Calls `fn`, a method of a DFP service, timing and counting the call.
+    """
+
+    timer = g.stats.get_timer("dfp_api.%s.%s" % (service, method))
+    timer.start()
+    start = time.time()
+    error = None
+
+    try:
+        return fn(*args, **kwargs)
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        timer.stop()
+        _record(service, method, _get_outcome(error), time.time() - start)
+
+
+def cache_event(cache, hit, delta=1):
+    g.stats.simple_event(
+        "dfp.cache.%s.%s" % (cache, "hit" if hit else "miss"), delta=delta)
+
+
+def get_profile():
+    """
+    Returns the per method totals and the most common sampled stacks.
+    """
+
+    with _profile_lock:
+        totals = {key: list(value) for key, value in _profile.iteritems()}
+        stacks = _stacks.most_common(PROFILE_TOP_STACKS)
+
+    return totals, stacks
+
+
+def dump_profile():
+    totals, stacks = get_profile()
+    lines = ["dfp api profile:"]
+
+    for (service, method, outcome), (calls, seconds, slowest) in sorted(
+            totals.iteritems(), key=lambda item: -item[1][1]):
+        lines.append("  %s.%s %s: %d calls, %.1fs total, %.0fms mean, "
+                     "%.0fms max" % (service, method, outcome, calls, seconds,
+                                     seconds / calls * 1000, slowest * 1000))
+
+    if stacks:
+        lines.append("sampled call stacks:")
+
+    for stack, count in stacks:
+        lines.append("  %d samples:" % count)
+        lines.extend("    %s" % frame for frame in stack)
+
+    g.log.info("\n".join(lines))
+
+
+def install_dump_signal(signum=signal.SIGUSR2):
+    """
+    Makes the process dump its profile when sent `signum`. Must be called
+    from the main thread.
+    """
+
+    signal.signal(signum, lambda signum, frame: dump_profile())
@@ -1,3 +1,6 @@
+import copy
+
+
 def merge(obj, *sources):
     if not sources:
         return obj
@@ -9,19 +12,153 @@ def merge(obj, *sources):
 
     return obj
 
-def merge_deep(obj, *sources):
-    if not sources:
-        return obj
+
+def _flatten(values):
+    """
+    Returns the (path, value) leaves of a nested dict.
+    """
+
+    leaves = []
+    stack = [((), values)]
+
+    while stack:
+        path, values = stack.pop()
+
+        for key, value in values.iteritems():
+            if isinstance(value, dict):
+                stack.append((path + (key,), value))
+            elif value is not None:
+                leaves.append((path + (key,), value))
+
+    return leaves
+
+
+def _is_mapping(value):
+    # suds objects keep their field names in __keylist__
+    return isinstance(value, dict) or hasattr(value, "__keylist__")
+
+
+def _items(mapping):
+    if isinstance(mapping, dict):
+        return mapping.items()
+
+    return [(key, getattr(mapping, key)) for key in mapping.__keylist__]
+
+
+def _get(mapping, key):
+    return mapping[key] if key in mapping else None
+
+
+def _copy(mapping):
+    if isinstance(mapping, dict):
+        return dict(mapping)
+
+    copied = mapping.__class__()
+    copied.__metadata__ = mapping.__metadata__
+    for key, value in _items(mapping):
+        setattr(copied, key, value)
+
+    return copied
+
+
+def _typed(mapping):
+    # suds objects carry their type already, dicts spell it out
+    return not isinstance(mapping, dict)
+
+
+def _equal(current, value):
+    """
+    Whether merging `value` over `current` would leave it unchanged.
+    """
+
+    if _is_mapping(value):
+        return _is_mapping(current) and all(
+            _equal(_get(current, key), item)
+                for key, item in _items(value)
+                if item is not None and not
+                    (key == "xsi_type" and _typed(current)))
+    elif isinstance(value, list):
+        return (isinstance(current, list) and len(current) == len(value) and
+            all(_equal(a, b) for a, b in zip(current, value)))
+
+    return current == value
+
+
+def merge_changes(obj, *sources):
+    """
+    Deep merges `sources` into `obj`, returning the result and the paths
+    (as tuples of keys) that changed.
+
+    Nested mappings (dicts or suds objects) are merged into field by field
+    and anything else, lists included, is replaced if it differs. `None`
+    values in a source are ignored. `obj` is never modified: a branch is
+    copied once when it's merged into and untouched branches are shared
+    with the result. Values taken from a source are copied so the result
+    never shares state with, say, module level defaults.
+    """
+
+    changes = []
+    owned = set()
+
+    def _own(container):
+        if id(container) not in owned:
+            container = _copy(container)
+            owned.add(id(container))
+
+        return container
+
+    result = _own(obj)
 
     for source in sources:
-        for prop, value in source.iteritems():
-            if value is None:
-                continue
-            elif (isinstance(value, dict) and
-                    isinstance(obj[prop], dict)):
-                obj[prop] = merge_deep(obj[prop], value)
-            else:
-                obj[prop] = value
+        stack = [(result, (), source)]
 
-    return obj
+        while stack:
+            target, path, values = stack.pop()
+
+            for key, value in _items(values):
+                if value is None:
+                    continue
+
+                if key == "xsi_type" and _typed(target):
+                    continue
+
+                current = _get(target, key)
+
+                if _is_mapping(value) and _is_mapping(current):
+                    current = _own(current)
+                    target[key] = current
+                    stack.append((current, path + (key,), value))
+                elif not _equal(current, value):
+                    target[key] = copy.deepcopy(value)
+                    changes.append(path + (key,))
+
+    return result, changes
+
+
+class Template(object):
+    """
+    Defaults that are flattened once so building an entity from them is a
+    walk over a list of leaves rather than a recursive merge.
+    """
+
+    def __init__(self, defaults):
+        self._leaves = _flatten(defaults)
+
+    def build(self, *sources):
+        """
+        Returns a new dict of the defaults with `sources` merged over them.
+        """
+
+        result = {}
+
+        for path, value in self._leaves:
+            target = result
+            for key in path[:-1]:
+                target = target.setdefault(key, {})
+
+            target[path[-1]] = copy.deepcopy(value)
+
+        if sources:
+            result, changes = merge_changes(result, *sources)
 
+        return result
@@ -0,0 +1,102 @@
+from itertools import islice
+
+from googleads import dfp
+
+PAGE_LIMIT = dfp.SUGGESTED_PAGE_LIMIT
+
+
+def number_list(values):
+    return ", ".join(str(int(value)) for value in values)
+
+
+def text_list(values):
+    return ", ".join("'%s'" % value.replace("'", "\\'") for value in values)
+
+
+def datetime_value(dt, timezone_id):
+    return {
+        "xsi_type": "DateTimeValue",
+        "value": {
+            "date": {
+                "year": dt.year,
+                "month": dt.month,
+                "day": dt.day,
+            },
+            "hour": dt.hour,
+            "minute": dt.minute,
+            "second": dt.second,
+            "timeZoneID": timezone_id,
+        },
+    }
+
+
+def chunks(values, size=PAGE_LIMIT):
+    values = iter(values)
+
+    while True:
+        chunk = list(islice(values, size))
+
+        if not chunk:
+            break
+
+        yield chunk
+
+
+def get_page(method, query, values=None, limit=PAGE_LIMIT, offset=0):
+    """
+    Returns a single page of a `get*ByStatement` call's results.
+    """
+
+    statement = dfp.FilterStatement(query, values, limit, offset)
+    response = method(statement.ToStatement())
+
+    return response["results"] if "results" in response else []
+
+
+def iter_results(method, query, values=None, page_size=PAGE_LIMIT):
+    """
+    Pages through every result of a `get*ByStatement` call.
+    """
+
+    statement = dfp.FilterStatement(query, values, page_size)
+
+    while True:
+        response = method(statement.ToStatement())
+
+        if "results" in response:
+            results = response["results"]
+        else:
+            results = []
+
+        for result in results:
+            yield result
+
+        if len(results) < page_size:
+            break
+
+        statement.offset += page_size
+
+
+def iter_rows(method, query, values=None, page_size=PAGE_LIMIT):
+    """
+    Pages through a PublisherQueryLanguageService `select`, yielding each
+    row as a dict keyed by column name.
+    """
+
+    statement = dfp.FilterStatement(query, values, page_size)
+
+    while True:
+        result_set = method(statement.ToStatement())
+        rows = getattr(result_set, "rows", None) or []
+
+        if rows:
+            labels = [column.labelName for column in result_set.columnTypes]
+
+        for row in rows:
+            yield dict(zip(labels,
+                [getattr(value, "value", None) for value in row.values]))
+
+        if len(rows) < page_size:
+            break
+
+        statement.offset += page_size
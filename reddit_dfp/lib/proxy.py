@@ -0,0 +1,43 @@
+from reddit_dfp.lib import (
+    instrument,
+    ratelimit,
+    retry,
+)
+
+
+class ServiceProxy(object):
+    """
+    Wraps a DFP service so every method call passes through the shared
+    rate limiter, is instrumented and is retried on transient failures
+    (only quota ones for creates, see `retry.call_create`).
+
+    The underlying service is only created, by `factory(name)`, when it's
+    first used.
+    """
+
+    def __init__(self, name, factory):
+        self.name = name
+        self._factory = factory
+
+    def __getattr__(self, attr):
+        service = self._factory(self.name)
+        method = getattr(service, attr)
+
+        if not callable(method):
+            return method
+
+        def _call(*args, **kwargs):
+            ratelimit.get_limiter().acquire()
+
+            return instrument.record_call(
+                self.name, attr, method, *args, **kwargs)
+
+        if attr.startswith("create"):
+            retrying = retry.call_create
+        else:
+            retrying = retry.call
+
+        def _call_with_retry(*args, **kwargs):
+            return retrying(_call, *args, **kwargs)
+
+        return _call_with_retry
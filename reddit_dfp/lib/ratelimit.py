@@ -0,0 +1,92 @@
+import threading
+import time
+
+from pylons import g
+
+DEFAULT_REQUESTS_PER_SECOND = 8
+DEFAULT_BACKEND = "local"
+
+
+class TokenBucket(object):
+    """
+    Allows `rate` calls per second (with bursts of up to `burst`) across
+    every thread in this process.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self._tokens = self.burst
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def _reserve(self):
+        with self._lock:
+            now = time.time()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= 1
+
+            if self._tokens >= 0:
+                return 0
+
+            return -self._tokens / self.rate
+
+    def acquire(self):
+        wait = self._reserve()
+
+        if wait:
+            time.sleep(wait)
+
+
+class MemcacheBucket(object):
+    """
+    Allows `rate` calls per second across every process sharing `cache`.
+
+    Calls are counted in one second windows; callers that find the current
+    window full wait for the next one.
+    """
+
+    def __init__(self, cache, rate, prefix="dfp_ratelimit"):
+        self.cache = cache
+        self.rate = int(rate)
+        self.prefix = prefix
+
+    def acquire(self):
+        while True:
+            now = time.time()
+            window = int(now)
+            key = "%s-%d" % (self.prefix, window)
+
+            self.cache.add(key, 0, time=2)
+            count = self.cache.incr(key)
+
+            # if memcache is unavailable don't block the caller
+            if count is None or count <= self.rate:
+                return
+
+            time.sleep(window + 1 - now)
+
+
+_limiter = None
+
+
+def get_limiter():
+    global _limiter
+
+    if _limiter is None:
+        rate = getattr(g, "dfp_requests_per_second", None)
+        backend = getattr(g, "dfp_ratelimit_backend", None)
+
+        rate = rate or DEFAULT_REQUESTS_PER_SECOND
+        backend = backend or DEFAULT_BACKEND
+
+        if backend == "memcache":
+            _limiter = MemcacheBucket(g.cache, rate)
+        elif backend == "local":
+            _limiter = TokenBucket(rate)
+        else:
+            raise ValueError("unknown dfp_ratelimit_backend: %s" % backend)
+
+    return _limiter
@@ -0,0 +1,97 @@
+import random
+import threading
+import time
+
+from pylons import g
+
+from reddit_dfp.lib import errors
+
+MAX_RETRIES = 3
+BASE_DELAY = 1
+MAX_DELAY = 30
+DEADLINE = 60
+
+_context = threading.local()
+
+
+class RetryLater(Exception):
+    """
+    Raised instead of sleeping when retries are being deferred; the caller
+    should try the whole operation again after `delay` seconds.
+    """
+
+    def __init__(self, delay, cause):
+        self.delay = delay
+        self.cause = cause
+        Exception.__init__(self, "retry in %ss: %r" % (delay, cause))
+
+
+class deferring(object):
+    """
+    Context manager that makes transient failures raise `RetryLater`
+    rather than block the current thread sleeping.
+    """
+
+    def __enter__(self):
+        self._previous = getattr(_context, "defer", False)
+        _context.defer = True
+
+    def __exit__(self, *exc_info):
+        _context.defer = self._previous
+
+
+def is_deferring():
+    return getattr(_context, "defer", False)
+
+
+def backoff(attempt, base=BASE_DELAY, maximum=MAX_DELAY):
+    """
+    Exponential backoff with full jitter.
+    """
+
+    return random.uniform(0, min(maximum, base * 2 ** attempt))
+
+
+def _call(is_retryable, fn, args, kwargs):
+    deadline = time.time() + DEADLINE
+    attempt = 0
+
+    while True:
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            if not is_retryable(e):
+                raise
+
+            wait = backoff(attempt)
+
+            if is_deferring():
+                raise RetryLater(wait, e)
+
+            if attempt >= MAX_RETRIES or time.time() + wait > deadline:
+                raise
+
+            g.log.warning("dfp call failed (attempt %d), retrying in %.1fs: "
+                          "%r" % (attempt + 1, wait, e))
+            time.sleep(wait)
+            attempt += 1
+
+
+def call(fn, *args, **kwargs):
+    """
+    Calls `fn`, retrying transient DFP failures with jittered exponential
+    backoff until MAX_RETRIES or DEADLINE is reached.
+    """
+
+    return _call(errors.is_transient, fn, args, kwargs)
+
+
+def call_create(fn, *args, **kwargs):
+    """
+    Like `call`, for creates. Those may have been applied even though the
+    call failed, so only quota faults, which DFP rejects before writing
+    anything, are retried; the caller has to look up what was created
+    before trying again.
+    """
+
+    return _call(errors.is_quota_error, fn, args, kwargs)
@@ -0,0 +1,95 @@
+import threading
+
+from multiprocessing.pool import ThreadPool
+
+import pylons
+
+from reddit_dfp.lib import (
+    instrument,
+    retry,
+)
+
+POOL_SIZE = 4
+
+_pool = None
+_lock = threading.Lock()
+
+
+def _get_pool():
+    global _pool
+
+    if _pool is None:
+        with _lock:
+            if _pool is None:
+                _pool = ThreadPool(POOL_SIZE)
+
+    return _pool
+
+
+def with_context(fn):
+    """
+    Wraps `fn` to run with the calling thread's pylons globals, retry mode
+    and API call counter, since none are inherited by the pool's threads.
+    """
+
+    app_globals = pylons.app_globals._current_obj()
+    deferring = retry.is_deferring()
+    counter = instrument.get_counter()
+
+    def _call(*args, **kwargs):
+        if deferring:
+            with retry.deferring():
+                return fn(*args, **kwargs)
+
+        return fn(*args, **kwargs)
+
+    def _run(*args, **kwargs):
+        pylons.app_globals._push_object(app_globals)
+        try:
+            if counter:
+                with instrument.counting(counter):
+                    return _call(*args, **kwargs)
+
+            return _call(*args, **kwargs)
+        finally:
+            pylons.app_globals._pop_object(app_globals)
+
+    return _run
+
+
+def run(graph):
+    """
+    Runs a graph of dependent tasks on a shared thread pool.
+
+    `graph` maps task names to (fn, requires) tuples; each fn is called
+    with the results of the tasks it requires as keyword arguments. Tasks
+    whose requirements are met run concurrently. Returns the results of
+    every task keyed by name and re-raises the first failure.
+    """
+
+    pool = _get_pool()
+    results = {}
+    pending = dict(graph)
+
+    while pending:
+        ready = [name for name, (fn, requires) in pending.iteritems()
+                    if all(r in results for r in requires)]
+
+        if not ready:
+            raise ValueError("unsatisfiable task requirements: %s" %
+                             ", ".join(sorted(pending)))
+
+        running = {}
+        for name in ready:
+            fn, requires = pending.pop(name)
+            kwargs = {r: results[r] for r in requires}
+
+            if len(ready) == 1:
+                results[name] = fn(**kwargs)
+            else:
+                running[name] = pool.apply_async(with_context(fn), (), kwargs)
+
+        for name, result in running.iteritems():
+            results[name] = result.get()
+
+    return results
@@ -1,8 +1,129 @@
+import time
+
+from contextlib import contextmanager
+from pylons import g
+
 from r2.lib.db import tdb_cassandra
+from r2.lib.lock import TimeoutExpired
 from r2.models import (
     Link,
 )
 
+from reddit_dfp.lib import (
+    instrument,
+    retry,
+)
+from reddit_dfp.lib.lru import LRUCache
+
+LOCAL_CACHE_SIZE = 10000
+LOCAL_CACHE_TIME = 60 * 5
+ID_MAP_TTL = 60 * 60 * 24
+LINK_CACHE_TIME = 60 * 60 * 24
+MISSING_CACHE_TIME = 60 * 10
+RENDER_CACHE_TIME = 60 * 60
+ACCOUNT_CACHE_SIZE = 10000
+ACCOUNT_CACHE_TIME = 60 * 60
+ASSOCIATION_CACHE_TIME = 60 * 60 * 24
+ACCOUNT_LOCK_TIME = 60
+ACCOUNT_LOCK_TIMEOUT = 10
+ACCOUNT_RETRY_DELAY = 30
+
+
+class IdStore(object):
+    """
+    Where the DFP ids of things are kept: attributes on the things
+    themselves, the DfpIdsByFullname rows (behind an in-process LRU), the
+    known associations in memcache and the per-kind account caches.
+    """
+
+    def __init__(self):
+        self._rows = LRUCache(LOCAL_CACHE_SIZE, ttl=LOCAL_CACHE_TIME)
+        self._account_caches = {}
+
+    def get_attr(self, thing, attr):
+        return getattr(thing, attr, None)
+
+    def set_attr(self, thing, attr, dfp_id):
+        if getattr(thing, attr, None) != dfp_id:
+            setattr(thing, attr, dfp_id)
+            thing._commit()
+
+    def get_row(self, fullname, fresh=False):
+        row = None if fresh else self._rows.get(fullname)
+        instrument.cache_event("dfp_ids_local", row is not None)
+
+        if row is None:
+            try:
+                row = dict(DfpIdsByFullname._byID(
+                    DfpIdsByFullname._row_key(fullname))._values())
+            except tdb_cassandra.NotFound:
+                row = {}
+
+            self._rows.set(fullname, row)
+
+        return row
+
+    def update_row(self, fullname, columns):
+        DfpIdsByFullname._set_values(
+            DfpIdsByFullname._row_key(fullname), columns)
+
+        row = dict(self.get_row(fullname))
+        row.update(columns)
+        self._rows.set(fullname, row)
+
+    def remove_columns(self, fullname, columns):
+        DfpIdsByFullname._cf.remove(
+            DfpIdsByFullname._row_key(fullname), columns)
+        self._rows.delete(fullname)
+
+    def get_flags(self, keys):
+        """
+        Returns the subset of `keys` that are set.
+        """
+
+        cached = g.cache.get_multi(keys)
+        return {key for key, value in cached.iteritems() if value}
+
+    def set_flags(self, keys, time):
+        g.cache.set_multi({key: True for key in keys}, time=time)
+
+    def get_account_cache(self, kind):
+        cache = self._account_caches.get(kind)
+
+        if cache is None:
+            cache = self._account_caches.setdefault(
+                kind, LRUCache(ACCOUNT_CACHE_SIZE, ttl=ACCOUNT_CACHE_TIME))
+
+        return cache
+
+
+_default_id_store = IdStore()
+_id_store = None
+
+
+def set_id_store(store):
+    """
+    Makes the id models read and write their ids through `store` instead
+    of the things, Cassandra and memcache, e.g. to keep the ids a fake DFP
+    hands out in memory. Pass None to go back to the real stores.
+    """
+
+    global _id_store
+    _id_store = store
+
+
+def _get_id_store():
+    return _id_store or _default_id_store
+
+
+def get_dfp_attr(thing, attr):
+    return _get_id_store().get_attr(thing, attr)
+
+
+def set_dfp_attr(thing, attr, dfp_id):
+    _get_id_store().set_attr(thing, attr, dfp_id)
+
+
 class LinksByExternalId(tdb_cassandra.View):
     _use_db = True
     _connection_pool = "main"
@@ -12,19 +133,429 @@ class LinksByExternalId(tdb_cassandra.View):
     def _row_key(external_id):
         return str(external_id)
 
+    @staticmethod
+    def _cache_key(external_id):
+        return "dfp_link_id-%s" % external_id
+
+    @staticmethod
+    def _missing_key(external_id):
+        return "dfp_link_missing-%s" % external_id
+
     @classmethod
     def add(cls, link):
         external_id = getattr(link, "external_id")
 
         cls._set_values(cls._row_key(external_id), {link._id36: ""})
+        g.cache.set(
+            cls._cache_key(external_id), link._id36, time=LINK_CACHE_TIME)
+        g.cache.delete(cls._missing_key(external_id))
 
     @classmethod
     def get(cls, external_id):
+        cache_key = cls._cache_key(external_id)
+        id36 = g.cache.get(cache_key)
+        instrument.cache_event("link_ids", id36 is not None)
+
+        if id36 is None:
+            try:
+                columns = cls._byID(cls._row_key(external_id))._values()
+                id36 = columns.keys()[0]
+            except tdb_cassandra.NotFound:
+                return None
+
+            g.cache.set(cache_key, id36, time=LINK_CACHE_TIME)
+
+        return Link._byID36(id36, data=True, return_dict=False)
+
+    @classmethod
+    def get_multi(cls, external_ids):
+        """
+        Returns the links for `external_ids` keyed by external id, leaving
+        out any without a link.
+        """
+
+        cache_keys = {cls._cache_key(external_id): external_id
+                        for external_id in external_ids}
+        cached = g.cache.get_multi(cache_keys.keys())
+        id36s = {cache_keys[key]: id36 for key, id36 in cached.iteritems()}
+        instrument.cache_event("link_ids", True, delta=len(id36s))
+        instrument.cache_event(
+            "link_ids", False, delta=len(external_ids) - len(id36s))
+
+        uncached = [external_id for external_id in external_ids
+                        if external_id not in id36s]
+        if uncached:
+            rows = cls._byID(map(cls._row_key, uncached), return_dict=True)
+            for external_id in uncached:
+                row = rows.get(cls._row_key(external_id))
+
+                if not row:
+                    continue
+
+                id36 = row._values().keys()[0]
+                id36s[external_id] = id36
+                g.cache.set(cls._cache_key(external_id), id36,
+                            time=LINK_CACHE_TIME)
+
+        if not id36s:
+            return {}
+
+        links = Link._byID36(id36s.values(), data=True, return_dict=True)
+
+        return {external_id: links[id36]
+                    for external_id, id36 in id36s.iteritems()
+                    if id36 in links}
+
+    @classmethod
+    def set_missing(cls, external_id):
+        """
+        Remembers that DFP has no creative for `external_id` so repeated
+        requests for it don't each go to DFP.
+        """
+
+        g.cache.set(cls._missing_key(external_id), True,
+                    time=MISSING_CACHE_TIME)
+
+    @classmethod
+    def get_missing(cls, external_ids):
+        missing_keys = {cls._missing_key(external_id): external_id
+                            for external_id in external_ids}
+        cached = g.cache.get_multi(missing_keys.keys())
+
+        return {missing_keys[key] for key, value in cached.iteritems()
+                    if value}
+
+
+
+class RenderedLinks(object):
+    """
+    Memcache of rendered third party promo links.
+
+    Entries are keyed by the link's votes and comment count, so a rendering
+    goes stale as soon as they change, and by a per-link version which
+    `invalidate` replaces, so every cached rendering of a link can be
+    dropped together.
+    """
+
+    @staticmethod
+    def _state(link):
+        # what a logged out rendering shows that changes after creation
+        return "%d.%d.%d" % (link._ups, link._downs,
+                             getattr(link, "num_comments", 0) or 0)
+
+    @staticmethod
+    def _version_key(link):
+        return "dfp_render_version-%s" % link._id36
+
+    @classmethod
+    def _get_version(cls, link):
+        version_key = cls._version_key(link)
+        version = g.cache.get(version_key)
+
+        if version is None:
+            version = str(int(time.time() * 1000))
+            g.cache.add(version_key, version)
+
+        return version
+
+    @classmethod
+    def _key(cls, link, *context):
+        return "dfp_render-%s-%s-%s-%s" % (
+            link._id36, cls._get_version(link), cls._state(link),
+            "-".join(map(str, context)))
+
+    @classmethod
+    def get(cls, link, *context):
+        rendered = g.cache.get(cls._key(link, *context))
+        instrument.cache_event("rendered", rendered is not None)
+
+        return rendered
+
+    @classmethod
+    def set(cls, link, rendered, *context):
+        g.cache.set(cls._key(link, *context), rendered,
+                    time=RENDER_CACHE_TIME)
+
+    @classmethod
+    def invalidate(cls, link):
+        g.cache.set(cls._version_key(link), str(int(time.time() * 1000)))
+
+
+class KnownAssociations(object):
+    """
+    Memcache of the (lineitem id, creative id) pairs known to be associated
+    in DFP, so syncing them again doesn't need to ask.
+    """
+
+    @staticmethod
+    def _key(lineitem_id, creative_id):
+        return "dfp_lica-%s-%s" % (lineitem_id, creative_id)
+
+    @classmethod
+    def get_unknown(cls, pairs):
+        """
+        Returns the pairs that aren't known to be associated.
+        """
+
+        keys = {cls._key(*pair): pair for pair in pairs}
+
+        known = _get_id_store().get_flags(keys.keys())
+
+        instrument.cache_event("associations", True, delta=len(known))
+        instrument.cache_event(
+            "associations", False, delta=len(keys) - len(known))
+
+        return {pair for key, pair in keys.iteritems() if key not in known}
+
+    @classmethod
+    def add(cls, pairs):
+        _get_id_store().set_flags([cls._key(*pair) for pair in pairs],
+                                  time=ASSOCIATION_CACHE_TIME)
+
+
+class DfpIdsByFullname(tdb_cassandra.View):
+    """
+    Maps reddit thing fullnames to the ids of their DFP entities.
+
+    Each DFP entity kind (lineitem, order, company, creative) is stored as
+    columns for its id, its last known version (lastModifiedDateTime),
+    when the mapping was last written and, for entities we write, the
+    fingerprint of the fields they were last synced with.
+    """
+
+    _use_db = True
+    _connection_pool = "main"
+    _read_consistency_level = tdb_cassandra.CL.ONE
+
+    @staticmethod
+    def _row_key(fullname):
+        return fullname
+
+    @staticmethod
+    def _columns(kind):
+        return kind, "%s_version" % kind, "%s_updated" % kind
+
+    @staticmethod
+    def _fingerprint_column(kind):
+        return "%s_fingerprint" % kind
+
+    @classmethod
+    def _get_row(cls, fullname, fresh=False):
+        return _get_id_store().get_row(fullname, fresh=fresh)
+
+    @classmethod
+    def add(cls, fullname, kind, dfp_id, version=None, fingerprint=None,
+            refresh=True):
+        """
+        Records the `kind` entity for `fullname`. Unless `refresh`, when the
+        mapping was last written (and so how long its fingerprint is
+        trusted) is left alone, for recording entities that were only read.
+        """
+
+        id_column, version_column, updated_column = cls._columns(kind)
+        updated = str(int(time.time()))
+
+        if not refresh:
+            updated = cls._get_row(fullname).get(updated_column) or updated
+
+        columns = {
+            id_column: str(dfp_id),
+            version_column: version or "",
+            updated_column: updated,
+        }
+
+        if fingerprint:
+            columns[cls._fingerprint_column(kind)] = fingerprint
+
+        _get_id_store().update_row(fullname, columns)
+
+    @classmethod
+    def get(cls, fullname, kind, max_age=ID_MAP_TTL, fresh=False):
+        """
+        Returns the (id, version) of the `kind` entity for `fullname`, or
+        None if there is no mapping or it is older than `max_age` seconds.
+        `fresh` skips the local cache.
+        """
+
+        id_column, version_column, updated_column = cls._columns(kind)
+        row = cls._get_row(fullname, fresh=fresh)
+
+        if not row.get(id_column):
+            instrument.cache_event("dfp_ids.%s" % kind, False)
+            return None
+
+        updated = int(row.get(updated_column) or 0)
+        if max_age is not None and updated + max_age < time.time():
+            instrument.cache_event("dfp_ids.%s" % kind, False)
+            return None
+
+        instrument.cache_event("dfp_ids.%s" % kind, True)
+
+        return int(row[id_column]), row.get(version_column) or None
+
+    @classmethod
+    def get_id(cls, fullname, kind, max_age=ID_MAP_TTL, fresh=False):
+        mapping = cls.get(fullname, kind, max_age=max_age, fresh=fresh)
+
+        return mapping[0] if mapping else None
+
+    @classmethod
+    def get_synced(cls, fullname, kind, fingerprint, max_age=ID_MAP_TTL):
+        """
+        Returns the id of the `kind` entity for `fullname` if it was last
+        synced with `fingerprint` no more than `max_age` seconds ago.
+        """
+
+        dfp_id = cls.get_id(fullname, kind, max_age=max_age)
+        row = cls._get_row(fullname)
+
+        if dfp_id and row.get(cls._fingerprint_column(kind)) == fingerprint:
+            return dfp_id
+
+        return None
+
+    @classmethod
+    def remove(cls, fullname, kind):
+        columns = cls._columns(kind) + (cls._fingerprint_column(kind),)
+        cls._remove_columns(fullname, columns)
+
+    @classmethod
+    def _remove_columns(cls, fullname, columns):
+        _get_id_store().remove_columns(fullname, columns)
+
+
+def get_dfp_version(entity):
+    """
+    Returns an entity's lastModifiedDateTime as a sortable string.
+    """
+
+    modified = getattr(entity, "lastModifiedDateTime", None)
+
+    if not modified:
+        return None
+
+    date = modified.date
+    return "%04d-%02d-%02dT%02d:%02d:%02d" % (
+        int(date.year), int(date.month), int(date.day),
+        int(modified.hour), int(modified.minute), int(modified.second))
+
+
+def record_dfp_id(fullname, kind, entity, fingerprint=None, refresh=True):
+    DfpIdsByFullname.add(fullname, kind, entity["id"],
+                         version=get_dfp_version(entity),
+                         fingerprint=fingerprint, refresh=refresh)
+
+
+class AccountDfpIds(object):
+    """
+    Resolves the id of an account's DFP `kind` entity (its company or
+    order) without asking DFP.
+
+    Ids are looked up in an in-process LRU, then the `attr` persisted on
+    the Account, then the id map. `forget` drops all three when DFP says
+    the entity is gone; other processes' LRUs expire it after
+    ACCOUNT_CACHE_TIME.
+
+    Creating an account's entity should happen inside `locking`, after
+    checking again with `get(fresh=True)`, since workers syncing different
+    campaigns of the same account would otherwise each create one.
+    """
+
+    def __init__(self, kind, attr):
+        self.kind = kind
+        self.attr = attr
+
+    def _get_local_cache(self):
+        return _get_id_store().get_account_cache(self.kind)
+
+    def get(self, account, fresh=False):
+        """
+        Returns the id, or None if it isn't known. `fresh` reads the id map
+        itself rather than the in-process cache.
+        """
+
+        dfp_id = None if fresh else self._get_local_cache().get(account._id)
+        instrument.cache_event("account.%s" % self.kind, dfp_id is not None)
+
+        if fresh:
+            dfp_id = (DfpIdsByFullname.get_id(account._fullname, self.kind,
+                                              max_age=None, fresh=True) or
+                get_dfp_attr(account, self.attr))
+        elif dfp_id is None:
+            dfp_id = (get_dfp_attr(account, self.attr) or
+                DfpIdsByFullname.get_id(account._fullname, self.kind))
+
+        if dfp_id:
+            self._get_local_cache().set(account._id, dfp_id)
+
+        return dfp_id
+
+    def set(self, account, entity):
+        dfp_id = entity["id"]
+
+        record_dfp_id(account._fullname, self.kind, entity)
+        self._get_local_cache().set(account._id, dfp_id)
+        set_dfp_attr(account, self.attr, dfp_id)
+
+    @contextmanager
+    def locking(self, accounts):
+        """
+        Holds the `kind` lock of each of `accounts`, taken in id order so
+        workers can't deadlock. Raises `RetryLater` if one is held elsewhere
+        for longer than ACCOUNT_LOCK_TIMEOUT.
+        """
+
+        locks = []
+
         try:
-            columns = cls._byID(cls._row_key(external_id))._values()
-            id36 = columns.keys()[0]
+            for account_id in sorted({account._id for account in accounts}):
+                lock = g.make_lock("dfp_sync",
+                                   "dfp_%s-%s" % (self.kind, account_id),
+                                   time=ACCOUNT_LOCK_TIME,
+                                   timeout=ACCOUNT_LOCK_TIMEOUT)
+
+                try:
+                    lock.acquire()
+                except TimeoutExpired as e:
+                    raise retry.RetryLater(ACCOUNT_RETRY_DELAY, e)
+
+                locks.append(lock)
+
+            yield
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    def forget(self, account):
+        self._get_local_cache().delete(account._id)
+        DfpIdsByFullname.remove(account._fullname, self.kind)
+
+        set_dfp_attr(account, self.attr, None)
+
+
+class DfpSyncState(tdb_cassandra.View):
+    """
+    Small named values (watermarks, checkpoints) kept by the sync jobs.
+    """
+
+    _use_db = True
+    _connection_pool = "main"
+    _read_consistency_level = tdb_cassandra.CL.QUORUM
+    _write_consistency_level = tdb_cassandra.CL.QUORUM
+
+    @staticmethod
+    def _row_key(name):
+        return name
+
+    @classmethod
+    def get(cls, name, default=None):
+        try:
+            columns = cls._byID(cls._row_key(name))._values()
         except tdb_cassandra.NotFound:
-            return None
+            return default
 
-        return Link._byID36(id36, data=True, return_dict=False)
+        return columns.get("value", default)
 
+    @classmethod
+    def set(cls, name, value):
+        cls._set_values(cls._row_key(name), {"value": value})
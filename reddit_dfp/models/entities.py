@@ -0,0 +1,164 @@
+"""
+Compact value objects for the DFP entities the plugin builds.
+
+They're converted to the dicts the SOAP client takes (`to_soap`) only
+when sending them; entities fetched from DFP stay suds objects. Item
+access by SOAP field name (`lineitem["id"]`) works the same on both, so
+either can be passed around.
+"""
+
+from reddit_dfp.lib.fingerprint import fingerprint
+
+
+class Entity(object):
+    __slots__ = ()
+
+    # (attribute, soap field) pairs
+    _fields = ()
+    _xsi_type = None
+
+    def __init__(self, **kwargs):
+        for attr, soap_name in self._fields:
+            setattr(self, attr, kwargs.pop(attr, None))
+
+        if kwargs:
+            raise TypeError("unexpected %s fields: %s" %
+                            (self.__class__.__name__, ", ".join(kwargs)))
+
+    @classmethod
+    def _attr(cls, soap_name):
+        for attr, name in cls._fields:
+            if name == soap_name:
+                return attr
+
+        return None
+
+    def __getitem__(self, soap_name):
+        attr = self._attr(soap_name)
+
+        if attr is None:
+            raise KeyError(soap_name)
+
+        return getattr(self, attr)
+
+    def __contains__(self, soap_name):
+        attr = self._attr(soap_name)
+
+        return attr is not None and getattr(self, attr) is not None
+
+    def __eq__(self, other):
+        return (type(self) is type(other) and
+            all(getattr(self, attr) == getattr(other, attr)
+                for attr, soap_name in self._fields))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "<%s %s>" % (self.__class__.__name__, ", ".join(
+            "%s=%r" % (attr, getattr(self, attr))
+                for attr, soap_name in self._fields
+                if getattr(self, attr) is not None))
+
+    def to_soap(self):
+        soap = {}
+
+        if self._xsi_type:
+            soap["xsi_type"] = self._xsi_type
+
+        for attr, soap_name in self._fields:
+            value = getattr(self, attr)
+
+            if isinstance(value, Entity):
+                value = value.to_soap()
+            elif isinstance(value, list):
+                value = [item.to_soap() if isinstance(item, Entity) else item
+                            for item in value]
+
+            if value is not None:
+                soap[soap_name] = value
+
+        return soap
+
+    def fingerprint(self):
+        return fingerprint(self.to_soap())
+
+
+class Advertiser(Entity):
+    __slots__ = ("id", "name", "type", "external_id")
+
+    _fields = (
+        ("id", "id"),
+        ("name", "name"),
+        ("type", "type"),
+        ("external_id", "externalId"),
+    )
+
+
+class Order(Entity):
+    __slots__ = ("id", "name", "advertiser_id", "salesperson_id",
+                 "trafficker_id", "external_order_id")
+
+    _fields = (
+        ("id", "id"),
+        ("name", "name"),
+        ("advertiser_id", "advertiserId"),
+        ("salesperson_id", "salespersonId"),
+        ("trafficker_id", "traffickerId"),
+        ("external_order_id", "externalOrderId"),
+    )
+
+
+class LineItem(Entity):
+    __slots__ = ("id", "order_id", "external_id", "name", "is_archived",
+                 "start_date_time", "end_date_time", "line_item_type",
+                 "cost_per_unit", "cost_type", "target_platform",
+                 "skip_inventory_check", "primary_goal", "targeting")
+
+    _fields = (
+        ("id", "id"),
+        ("order_id", "orderId"),
+        ("external_id", "externalId"),
+        ("name", "name"),
+        ("is_archived", "isArchived"),
+        ("start_date_time", "startDateTime"),
+        ("end_date_time", "endDateTime"),
+        ("line_item_type", "lineItemType"),
+        ("cost_per_unit", "costPerUnit"),
+        ("cost_type", "costType"),
+        ("target_platform", "targetPlatform"),
+        ("skip_inventory_check", "skipInventoryCheck"),
+        ("primary_goal", "primaryGoal"),
+        ("targeting", "targeting"),
+    )
+
+
+class TemplateVariable(Entity):
+    __slots__ = ("xsi_type", "unique_name", "value")
+
+    _fields = (
+        ("xsi_type", "xsi_type"),
+        ("unique_name", "uniqueName"),
+        ("value", "value"),
+    )
+
+    @classmethod
+    def string(cls, unique_name, value):
+        return cls(xsi_type="StringCreativeTemplateVariableValue",
+                   unique_name=unique_name, value=value)
+
+    @classmethod
+    def url(cls, unique_name, value):
+        return cls(xsi_type="UrlCreativeTemplateVariableValue",
+                   unique_name=unique_name, value=value)
+
+
+class Creative(Entity):
+    __slots__ = ("id", "name", "advertiser_id", "template_variables")
+
+    _fields = (
+        ("id", "id"),
+        ("name", "name"),
+        ("advertiser_id", "advertiserId"),
+        ("template_variables", "creativeTemplateVariableValues"),
+    )
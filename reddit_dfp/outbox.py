@@ -0,0 +1,212 @@
+"""
+A write-ahead outbox for the sync events raised by the promote hooks.
+
+`add` appends an event to a spool file owned by the current process and
+returns without touching AMQP. A background thread claims the spool every
+FLUSH_INTERVAL seconds (or sooner once MAX_BATCH events are waiting),
+coalesces it and publishes it to `dfp_q` as batch messages. A claimed
+spool is only removed once the broker has accepted everything in it, so
+events survive a broker outage, and spools left behind by dead processes
+are picked up by the next flusher on the host.
+"""
+
+import errno
+import itertools
+import json
+import os
+import re
+import tempfile
+import threading
+
+from os import path
+from pylons import g
+
+from reddit_dfp import queue
+from reddit_dfp.lib import (
+    pql,
+    tasks,
+)
+
+FLUSH_INTERVAL = 1
+MAX_BATCH = queue.BATCH_SIZE
+# spools are "<pid>.spool", claimed spools are "<pid>-<seq>.flushing"
+SPOOL_RE = re.compile(r"^(\d+)(?:-(\d+))?\.(spool|flushing)$")
+
+_lock = threading.Lock()
+_wakeup = threading.Event()
+_sequence = itertools.count()
+_pending = 0
+_flusher_pid = None
+
+
+def _get_dir():
+    directory = (getattr(g, "dfp_outbox_dir", None) or
+                 path.join(tempfile.gettempdir(), "reddit_dfp_outbox"))
+
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    return directory
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+
+    return True
+
+
+def _claim(directory, filename):
+    """
+    Renames a spool to a claimed spool owned by this process. Returns
+    False if it doesn't exist (or another process got there first).
+    """
+
+    claimed = path.join(directory,
+        "%d-%d.flushing" % (os.getpid(), next(_sequence)))
+
+    try:
+        os.rename(path.join(directory, filename), claimed)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return False
+        raise
+
+    return True
+
+
+def _recover(directory):
+    """
+    Claims the spools of processes that are no longer running.
+    """
+
+    for filename in os.listdir(directory):
+        match = SPOOL_RE.match(filename)
+
+        if not match:
+            continue
+
+        pid = int(match.group(1))
+        if pid != os.getpid() and not _is_alive(pid):
+            if _claim(directory, filename):
+                g.log.info("dfp outbox: recovered %s" % filename)
+
+
+def _get_claimed(directory):
+    claimed = []
+
+    for filename in os.listdir(directory):
+        match = SPOOL_RE.match(filename)
+
+        if (match and match.group(3) == "flushing" and
+                int(match.group(1)) == os.getpid()):
+            claimed.append((int(match.group(2)), filename))
+
+    # oldest first
+    return [filename for sequence, filename in sorted(claimed)]
+
+
+def _read(filename):
+    messages = []
+
+    with open(filename, "rb") as f:
+        for line in f:
+            try:
+                action, payload = json.loads(line)
+            except ValueError:
+                # a write torn by a crash
+                g.log.warning("dfp outbox: skipping bad record %r in %s" %
+                              (line, filename))
+                continue
+
+            messages.append((action, payload))
+
+    return messages
+
+
+def _publish(filename):
+    messages = _read(filename)
+    survivors = [messages[i] for i in queue.coalesce(messages)]
+
+    queue.publish_batches(pql.chunks(survivors, MAX_BATCH))
+
+    g.stats.simple_event("dfp.outbox.published", delta=len(survivors))
+    g.stats.simple_event("dfp.outbox.coalesced",
+                         delta=len(messages) - len(survivors))
+
+
+def flush():
+    """
+    Publishes everything spooled by this process, along with any spools
+    abandoned by dead processes.
+    """
+
+    global _pending
+
+    directory = _get_dir()
+
+    with _lock:
+        _claim(directory, "%d.spool" % os.getpid())
+        _pending = 0
+
+    _recover(directory)
+
+    for filename in _get_claimed(directory):
+        filename = path.join(directory, filename)
+        _publish(filename)
+        os.remove(filename)
+
+
+def _run_flusher():
+    while True:
+        _wakeup.wait(FLUSH_INTERVAL)
+        _wakeup.clear()
+
+        try:
+            flush()
+        except Exception as e:
+            # the spool stays claimed, so it's retried on the next tick
+            g.log.warning("dfp outbox: flush failed: %r" % e)
+
+
+def _ensure_flusher():
+    global _flusher_pid
+
+    # threads don't survive a fork, so each process starts its own
+    if _flusher_pid == os.getpid():
+        return
+
+    thread = threading.Thread(
+        target=tasks.with_context(_run_flusher), name="dfp_outbox")
+    thread.daemon = True
+    thread.start()
+
+    _flusher_pid = os.getpid()
+
+
+def add(action, payload):
+    """
+    Spools a message for `dfp_q`, to be published by the flusher.
+    """
+
+    global _pending
+
+    record = json.dumps([action, payload], separators=(",", ":"))
+    spool = path.join(_get_dir(), "%d.spool" % os.getpid())
+
+    with _lock:
+        _ensure_flusher()
+
+        with open(spool, "ab") as f:
+            f.write(record + "\n")
+
+        _pending += 1
+        if _pending >= MAX_BATCH:
+            _wakeup.set()
+
+    g.stats.simple_event("dfp.outbox.add")
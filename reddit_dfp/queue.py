@@ -1,11 +1,14 @@
 import json
+import zlib
 
 from collections import defaultdict
+from multiprocessing.pool import ThreadPool
 from pylons import g
 
 from r2.lib import (
     amqp,
 )
+from r2.lib.lock import TimeoutExpired
 from r2.models import (
     Account,
     Link,
@@ -13,19 +16,54 @@ from r2.models import (
     PromoCampaign,
 )
 
-from reddit_dfp.services import lineitems_service
+from reddit_dfp.lib import (
+    errors,
+    instrument,
+    retry,
+    tasks,
+)
+from reddit_dfp.services import (
+    creatives_service,
+    lineitems_service,
+)
 
 
 DFP_QUEUE = "dfp_q"
+BATCH_ACTION = "batch"
+BATCH_SIZE = 100
+MAX_DEFERRALS = 10
+# deferred messages wait in the first of these queues whose delay is long
+# enough, then expire back onto DFP_QUEUE
+DEFERRAL_DELAYS = (5, 30, 2 * 60, 10 * 60)
+# groups of a batch are synced in this order, so a link's creative exists
+# before its campaigns are associated with it
+ACTION_ORDER = ("upsert_promotion", "upsert_campaign", "deactivate_campaign")
+LOCK_TIME = 5 * 60
+LOCK_TIMEOUT = 10
+LOCK_RETRY_DELAY = 30
+
+_channel_broken = False
+
+
+class MissingCreative(Exception):
+    """
+    Raised when a campaign's link has no creative yet, usually because the
+    link's own upsert_promotion hasn't been handled. Retried, unlike
+    errors about the data itself.
+    """
 
 
 class Processor():
     def __init__(self):
         self._handlers = defaultdict(list)
+        self._batch_handlers = {}
 
-    def get_handlers(action):
+    def get_handlers(self, action):
         return self._handlers[action]
 
+    def get_batch_handler(self, action):
+        return self._batch_handlers.get(action)
+
     def call(self, action, *args, **kwargs):
         handlers = self.get_handlers(action)
         results = []
@@ -35,44 +73,509 @@ class Processor():
 
         return results
 
+    def call_batch(self, action, payloads):
+        """
+        Dispatches a list of payloads for a single action.
+
+        Uses the batch handler if one is registered, falling back to the
+        single handlers one payload at a time if it fails so that one bad
+        payload can't fail the whole batch. Returns a dict of the failed
+        payloads' indices to the exceptions they raised.
+        """
+
+        batch_handler = self.get_batch_handler(action)
+
+        if batch_handler:
+            try:
+                batch_handler(payloads)
+                return {}
+            except retry.RetryLater as e:
+                # retrying individually would just run into the same wall
+                return {i: e for i in xrange(len(payloads))}
+            except Exception as e:
+                g.log.warning("%s: batch of %d \"%s\" failed, retrying "
+                              "individually: %r" %
+                              (DFP_QUEUE, len(payloads), action, e))
+
+        failures = {}
+        for i, payload in enumerate(payloads):
+            try:
+                self.call(action, payload)
+            except Exception as e:
+                failures[i] = e
+
+        return failures
+
     def register(self, action, handler):
         existing = self.get_handlers(action)
-        action.append(handler)
+        existing.append(handler)
 
+    def register_batch(self, action, handler):
+        self._batch_handlers[action] = handler
 
-def process():
+
+def _get_processor():
     processor = Processor()
     processor.register("upsert_promotion", _handle_upsert_promotion)
     processor.register("upsert_campaign", _handle_upsert_campaign)
     processor.register("deactivate_campaign", _handle_deactivate_campaign)
 
+    processor.register_batch("upsert_promotion", _handle_upsert_promotions)
+    processor.register_batch("upsert_campaign", _handle_upsert_campaigns)
+    processor.register_batch(
+        "deactivate_campaign", _handle_deactivate_campaigns)
+
+    return processor
+
+
+def _decode(body):
+    """
+    Returns the (action, payload, data) of every message in an item,
+    unpacking the batches published by the outbox.
+    """
+
+    data = json.loads(body)
+
+    if data["action"] == BATCH_ACTION:
+        messages = data["messages"]
+    else:
+        messages = [data]
+
+    return [(message["action"], message.get("payload"), message)
+                for message in messages]
+
+
+def _coalesce_key(action, payload):
+    payload = payload or {}
+
+    # a forced message can't be covered by a later one that isn't
+    return (action, payload.get("link"), payload.get("campaign"),
+            bool(payload.get("force")))
+
+
+def coalesce(messages):
+    """
+    Collapses redundant messages from a list of (action, payload) tuples.
+
+    Only the latest message for each (action, link, campaign, force) is
+    kept and a `deactivate_campaign` supersedes any `upsert_campaign` for
+    the same campaign. Returns the indices of the surviving messages in
+    their original order.
+    """
+
+    deactivated = {
+        payload.get("campaign") for action, payload in messages
+            if action == "deactivate_campaign"}
+
+    latest = {}
+    for i, (action, payload) in enumerate(messages):
+        if (action == "upsert_campaign" and
+                payload.get("campaign") in deactivated):
+            continue
+
+        latest[_coalesce_key(action, payload)] = i
+
+    return sorted(latest.itervalues())
+
+
+def _record_api_calls(action, messages, calls):
+    """
+    Counts the DFP API calls spent on `messages` messages of `action`, so
+    calls per message can be graphed for each action.
+    """
+
+    g.stats.simple_event("dfp.messages.%s" % action, delta=messages)
+    g.stats.simple_event("dfp.api_calls.%s" % action, delta=calls)
+
+
+def process():
+    processor = _get_processor()
+    instrument.install_dump_signal()
+
     @g.stats.amqp_processor(DFP_QUEUE)
     def _handler(message):
-        data = json.loads(message.body)
-        g.log.debug("processing action: %s" % data)
-
-        action = data.get("action")
-        payload = data.get("payload")
+        for action, payload, data in _decode(message.body):
+            g.log.debug("processing action: %s" % data)
 
-        processor.call(action, payload)
+            counter = instrument.counting()
+            try:
+                with counter:
+                    processor.call(action, payload)
+            finally:
+                _record_api_calls(action, 1, counter.calls)
 
     amqp.consume_items(DFP_QUEUE, _handler, verbose=False)
 
 
+def _entity_key(action, payload):
+    payload = payload or {}
+
+    return payload.get("campaign") or payload.get("link") or action
+
+
+def _partition_key(action, payload):
+    payload = payload or {}
+
+    return payload.get("link") or payload.get("campaign") or action
+
+
+def _partition(messages, count):
+    """
+    Splits messages into `count` lists so that every message for the same
+    link, whether about the link or one of its campaigns, lands in the
+    same list and so is synced in ACTION_ORDER.
+    """
+
+    partitions = [[] for i in xrange(count)]
+
+    for message in messages:
+        item, action, payload, data = message
+        key = _partition_key(action, payload)
+        partitions[zlib.crc32(key) % count].append(message)
+
+    return [partition for partition in partitions if partition]
+
+
+class _Acks(object):
+    """
+    Acks or rejects the messages in a list of items.
+
+    An item that carries several messages (an outbox batch) is only acked
+    once all of them are handled, and any of them that need to be requeued
+    are republished on their own.
+    """
+
+    def __init__(self, chan):
+        self.chan = chan
+        self.shared = set()
+
+    def ack(self, item):
+        if item.delivery_tag not in self.shared:
+            self.chan.basic_ack(item.delivery_tag)
+
+    def reject(self, item, data, requeue):
+        if item.delivery_tag not in self.shared:
+            self.chan.basic_reject(item.delivery_tag, requeue=requeue)
+        elif requeue:
+            _push(data)
+
+    def finish(self):
+        for delivery_tag in self.shared:
+            self.chan.basic_ack(delivery_tag)
+
+
+def _action_rank(action):
+    if action in ACTION_ORDER:
+        return ACTION_ORDER.index(action)
+
+    return len(ACTION_ORDER)
+
+
+def _lock(keys):
+    """
+    Locks the entities in `keys`, always in the same order so workers can't
+    deadlock. Returns the locks acquired and the keys that couldn't be
+    locked within LOCK_TIMEOUT.
+    """
+
+    acquired = []
+    timed_out = {}
+
+    for key in sorted(keys):
+        lock = g.make_lock("dfp_sync", "dfp_sync-%s" % key,
+                           time=LOCK_TIME, timeout=LOCK_TIMEOUT)
+        try:
+            lock.acquire()
+        except TimeoutExpired as e:
+            timed_out[key] = e
+            continue
+
+        acquired.append(lock)
+
+    return acquired, timed_out
+
+
+def _dispatch(processor, messages):
+    """
+    Syncs a list of decoded messages, grouped by action (in ACTION_ORDER),
+    and returns an (item, data, exception or None) outcome for each.
+
+    The entities in each action's group are locked while it's synced, so
+    other workers (in this process or elsewhere) can't sync the same
+    entity at the same time. Messages whose entity is locked elsewhere
+    fail with `RetryLater`.
+    """
+
+    by_action = defaultdict(list)
+    for message in messages:
+        item, action, payload, data = message
+        by_action[action].append(message)
+
+    outcomes = []
+
+    with retry.deferring():
+        for action in sorted(by_action, key=_action_rank):
+            group = by_action[action]
+            locks, timed_out = _lock({_entity_key(action, payload)
+                for item, action, payload, data in group})
+
+            try:
+                ready = []
+                for message in group:
+                    item, action, payload, data = message
+                    e = timed_out.get(_entity_key(action, payload))
+
+                    if e:
+                        outcomes.append((item, data,
+                            retry.RetryLater(LOCK_RETRY_DELAY, e)))
+                    else:
+                        ready.append(message)
+
+                if not ready:
+                    continue
+
+                g.log.debug("%s: processing %d \"%s\"" %
+                            (DFP_QUEUE, len(ready), action))
+
+                payloads = [payload for item, action, payload, data in ready]
+                with instrument.counting() as counter:
+                    failures = processor.call_batch(action, payloads)
+                _record_api_calls(action, len(payloads), counter.calls)
+
+                for i, (item, action, payload, data) in enumerate(ready):
+                    outcomes.append((item, data, failures.get(i)))
+            finally:
+                for lock in reversed(locks):
+                    lock.release()
+
+    return outcomes
+
+
+def process_batched(batch_size=BATCH_SIZE, workers=1):
+    """
+    Consumes `dfp_q` in batches of up to `batch_size` messages.
+
+    Redundant messages are coalesced, then the rest are grouped by action
+    and sent to DFP through the list based service calls. Messages are
+    still acked (or requeued) individually, except that the messages of an
+    outbox batch share a single ack.
+
+    With `workers` > 1 each batch is partitioned by link across that many
+    threads, so updates to a link and its campaigns are still applied in
+    order.
+
+    Failures don't block the consumer: the message is parked in a delay
+    queue to be retried after a backoff while the worker moves on to other
+    messages. Messages that can't succeed on retry are dropped.
+    """
+
+    processor = _get_processor()
+    pool = ThreadPool(workers) if workers > 1 else None
+    instrument.install_dump_signal()
+
+    def _handle_items(items, chan):
+        timer = g.stats.get_timer("dfp.batch")
+        timer.start()
+
+        acks = _Acks(chan)
+        decoded = []
+        for item in items:
+            try:
+                messages = _decode(item.body)
+            except (ValueError, KeyError) as e:
+                g.log.error("%s: dropping malformed message %r: %s" %
+                            (DFP_QUEUE, item.body, e))
+                chan.basic_reject(item.delivery_tag, requeue=False)
+                continue
+
+            if len(messages) > 1:
+                acks.shared.add(item.delivery_tag)
+
+            for action, payload, data in messages:
+                decoded.append((item, action, payload, data))
+
+        survivors = coalesce(
+            [(action, payload) for item, action, payload, data in decoded])
+        superseded = len(decoded) - len(survivors)
+        if superseded:
+            g.stats.simple_event("dfp.coalesced", delta=superseded)
+
+        ready = [decoded[i] for i in survivors]
+
+        if pool and ready:
+            dispatch = tasks.with_context(
+                lambda messages: _dispatch(processor, messages))
+            partitions = _partition(ready, workers)
+            outcomes = sum(pool.map(dispatch, partitions), [])
+        elif ready:
+            outcomes = _dispatch(processor, ready)
+        else:
+            outcomes = []
+
+        # the channel isn't thread safe, so everything is acked from here
+        for item, data, e in outcomes:
+            if e:
+                _handle_failure(acks, item, data, e)
+            else:
+                acks.ack(item)
+
+        # superseded messages are covered by whichever message replaced
+        # them, which has been acked or requeued above.
+        survivors = set(survivors)
+        for i, (item, action, payload, data) in enumerate(decoded):
+            if i not in survivors:
+                acks.ack(item)
+
+        acks.finish()
+
+        timer.stop()
+
+    declare_delay_queues()
+    amqp.handle_items(DFP_QUEUE, _handle_items, limit=batch_size,
+                      ack=False, verbose=False)
+
+
+def _handle_failure(acks, item, data, e):
+    action = data["action"]
+    payload = data.get("payload")
+    cause = e.cause if isinstance(e, retry.RetryLater) else e
+
+    if isinstance(cause, NotFound) or errors.is_permanent(cause):
+        g.log.error("%s: dropping \"%s\" %s, it can't succeed on retry: %r" %
+                    (DFP_QUEUE, action, payload, cause))
+        g.stats.simple_event("dfp.dropped")
+        acks.reject(item, data, requeue=False)
+        return
+
+    attempt = data.get("attempt", 0) + 1
+
+    if attempt > MAX_DEFERRALS:
+        g.log.error("%s: giving up on \"%s\" %s after %d attempts: %r" %
+                    (DFP_QUEUE, action, payload, attempt, cause))
+        g.stats.simple_event("dfp.dropped")
+        acks.reject(item, data, requeue=False)
+        return
+
+    delay = retry.backoff(attempt, maximum=DEFERRAL_DELAYS[-1])
+    if isinstance(e, retry.RetryLater):
+        delay = max(e.delay, delay)
+
+    g.log.warning("%s: deferring \"%s\" %s for %.1fs: %r" %
+                  (DFP_QUEUE, action, payload, delay, cause))
+
+    _defer(dict(data, attempt=attempt), delay)
+    acks.ack(item)
+
+
+def _delay_queue(delay):
+    return "%s_delay_%d" % (DFP_QUEUE, delay)
+
+
+def declare_delay_queues():
+    """
+    Declares a queue for each of DEFERRAL_DELAYS whose messages expire,
+    after that delay, back onto DFP_QUEUE.
+    """
+
+    chan = amqp.connection_manager.get_channel()
+
+    for delay in DEFERRAL_DELAYS:
+        name = _delay_queue(delay)
+        chan.queue_declare(queue=name, durable=True, exclusive=False,
+                           auto_delete=False, arguments={
+                               "x-message-ttl": delay * 1000,
+                               "x-dead-letter-exchange": amqp.amqp_exchange,
+                               "x-dead-letter-routing-key": DFP_QUEUE,
+                           })
+        chan.queue_bind(routing_key=name, queue=name,
+                        exchange=amqp.amqp_exchange)
+
+
+def _defer(data, delay):
+    # the shortest delay queue that waits at least `delay`
+    for queue_delay in DEFERRAL_DELAYS:
+        if queue_delay >= delay:
+            break
+
+    amqp.add_item(_delay_queue(queue_delay), json.dumps(data))
+
+
+def _push(data):
+    amqp.add_item(DFP_QUEUE, json.dumps(data))
+
+
+def _encode_batch(messages):
+    return json.dumps({
+        "action": BATCH_ACTION,
+        "messages": [{"action": action, "payload": payload}
+                        for action, payload in messages],
+    })
+
+
+def publish_batches(batches):
+    """
+    Publishes lists of (action, payload) tuples, each as a single message,
+    and only returns once the broker has accepted all of them.
+
+    `amqp.add_item` just hands messages to a background thread that logs
+    and drops anything it fails to publish, so these are published on
+    this thread's own channel inside a transaction instead.
+    """
+
+    global _channel_broken
+
+    chan = amqp.connection_manager.get_channel(_channel_broken)
+    _channel_broken = True
+
+    chan.tx_select()
+    for messages in batches:
+        g.log.debug("%s: publishing batch of %d" % (DFP_QUEUE, len(messages)))
+        message = amqp.amqp.Message(_encode_batch(messages),
+                                    delivery_mode=amqp.DELIVERY_DURABLE)
+        chan.basic_publish(message, exchange=amqp.amqp_exchange,
+                           routing_key=DFP_QUEUE)
+    chan.tx_commit()
+
+    # only reconnect for the next call if something above failed
+    _channel_broken = False
+
+
 def push(action, payload):
     g.log.debug("%s: queuing action \"%s\"" % (DFP_QUEUE, action))
-    message = json.dumps({
+    _push({
         "action": action,
         "payload": payload,
     })
-    amqp.add_item(DFP_QUEUE, message)
 
 
 def _handle_upsert_promotion(payload):
     link = Link._by_fullname(payload["link"], data=True)
     author = Account._byID(link.author_id)
 
-    creatives_service.upsert_creative(author, link)
+    creatives_service.upsert_creative(
+        author, link, force=payload.get("force", False))
+
+
+def _forced(payloads, key):
+    # fullnames that a `force` payload asked to write whether or not they
+    # look unchanged
+    return {payload[key] for payload in payloads if payload.get("force")}
+
+
+def _handle_upsert_promotions(payloads):
+    links = Link._by_fullname(
+        {payload["link"] for payload in payloads},
+        data=True, return_dict=False)
+    authors = Account._byID(
+        {link.author_id for link in links}, data=True, return_dict=True)
+    forced = _forced(payloads, "link")
+
+    for force in (False, True):
+        pairs = [(authors[link.author_id], link) for link in links
+                    if (link._fullname in forced) == force]
+
+        if pairs:
+            creatives_service.upsert_creatives(pairs, force=force)
 
 
 def _handle_upsert_campaign(payload):
@@ -80,17 +583,58 @@ def _handle_upsert_campaign(payload):
     campaign = PromoCampaign._by_fullname(payload["campaign"], data=True)
     owner = Account._byID(campaign.owner_id)
 
-    lineitem = lineitems_service.upsert_lineitem(owner, campaign)
-    creative = creatives_service.get_creative(link)
+    lineitem = lineitems_service.upsert_lineitem(
+        owner, campaign, force=payload.get("force", False))
+
+    creative = creatives_service.get_creative_stub(link)
+    if not creative:
+        raise MissingCreative("no creative for link %s" % link._fullname)
+
+    lineitems_service.associate_with_creative(lineitem, creative)
+
 
-    lineitems_service.associate_with_creative(
-        lineitem=lineitem, creative=creative)
+def _handle_upsert_campaigns(payloads):
+    links = Link._by_fullname(
+        {payload["link"] for payload in payloads},
+        data=True, return_dict=True)
+    campaigns = PromoCampaign._by_fullname(
+        {payload["campaign"] for payload in payloads},
+        data=True, return_dict=True)
+    owners = Account._byID(
+        {campaign.owner_id for campaign in campaigns.itervalues()},
+        data=True, return_dict=True)
+
+    forced = _forced(payloads, "campaign")
+
+    lineitems = {}
+    for force in (False, True):
+        pairs = [(owners[campaign.owner_id], campaign)
+                    for fullname, campaign in campaigns.iteritems()
+                    if (fullname in forced) == force]
+
+        if pairs:
+            lineitems.update(
+                lineitems_service.upsert_lineitems(pairs, force=force))
+
+    pairs = []
+    for payload in payloads:
+        creative = creatives_service.get_creative_stub(links[payload["link"]])
+        if not creative:
+            raise MissingCreative("no creative for link %s" % payload["link"])
+
+        pairs.append((lineitems[payload["campaign"]], creative))
+
+    lineitems_service.associate_with_creatives(pairs)
 
 
 def _handle_deactivate_campaign(payload):
     campaign = PromoCampaign._by_fullname(payload["campaign"])
 
-    lineitem = lineitems_service.get_lineitem(campaign)
-    if lineitem:
-        lineitems_service.deactivate(lineitem)
+    lineitems_service.deactivate(campaign)
+
+
+def _handle_deactivate_campaigns(payloads):
+    campaigns = PromoCampaign._by_fullname(
+        {payload["campaign"] for payload in payloads}, return_dict=False)
 
+    lineitems_service.deactivate_campaigns(campaigns)
@@ -0,0 +1,332 @@
+"""
+Full reconciliation of reddit's promo campaigns with their DFP lineitems.
+
+Hook driven syncing can't recover from dropped messages or failed
+handlers, so this compares both sides and writes whatever corrections are
+needed. Both sides are streamed a page at a time. Run it nightly with:
+
+    paster run run.ini -c "from reddit_dfp import reconcile; reconcile.run()"
+
+`sync_changes` is the cheap incremental version: it only looks at DFP
+entities modified since it last ran.
+"""
+
+from collections import Counter
+from datetime import datetime, timedelta
+
+from pylons import g
+
+from r2.lib.utils import (
+    fetch_things2,
+    to36,
+)
+from r2.models import (
+    Account,
+    Link,
+    PromoCampaign,
+)
+
+from reddit_dfp import queue
+from reddit_dfp.lib import pql
+from reddit_dfp.models.cache import (
+    DfpSyncState,
+    get_dfp_version,
+    record_dfp_id,
+)
+from reddit_dfp.services import (
+    creatives_service,
+    lineitems_service,
+)
+
+PAGE_SIZE = pql.PAGE_LIMIT
+WATERMARK_FORMAT = "%Y-%m-%dT%H:%M:%S"
+FIRST_SYNC_WINDOW = timedelta(days=1)
+
+
+def _live_campaigns():
+    now = datetime.now(g.tz)
+    query = PromoCampaign._query(PromoCampaign.c.end_date > now, data=True)
+
+    return fetch_things2(query, chunk_size=PAGE_SIZE, chunks=True)
+
+
+def _campaign_prefix():
+    return PromoCampaign._type_prefix + to36(PromoCampaign._type_id) + "_"
+
+
+def reconcile_campaigns(dry_run=False):
+    """
+    Creates or updates the lineitems of live campaigns that are missing
+    from or out of date in DFP, associating the ones it creates with their
+    links' creatives.
+    """
+
+    counts = Counter()
+
+    for campaigns in _live_campaigns():
+        lineitems = lineitems_service.get_lineitems(campaigns)
+        out_of_sync = []
+
+        for campaign in campaigns:
+            lineitem = lineitems.get(campaign._fullname)
+
+            if not lineitem:
+                counts["missing"] += 1
+                out_of_sync.append(campaign)
+            elif lineitem["isArchived"]:
+                counts["archived"] += 1
+            elif not lineitems_service.is_synced(campaign, lineitem):
+                counts["changed"] += 1
+                out_of_sync.append(campaign)
+            else:
+                counts["synced"] += 1
+
+        if out_of_sync and not dry_run:
+            _sync_campaigns(out_of_sync, lineitems)
+
+    return counts
+
+
+def _sync_campaigns(campaigns, lineitems):
+    # writes the lineitems of `campaigns` and associates the ones that had
+    # to be created with their links' creatives
+    missing = [campaign for campaign in campaigns
+                if campaign._fullname not in lineitems]
+    links = Link._byID({campaign.link_id for campaign in missing},
+                       data=True, return_dict=True)
+    links = {link_id: link for link_id, link in links.iteritems()
+                if not link._deleted}
+    owners = Account._byID(
+        {campaign.owner_id for campaign in campaigns} |
+        {link.author_id for link in links.itervalues()},
+        data=True, return_dict=True)
+
+    synced = lineitems_service.upsert_lineitems(
+        [(owners[campaign.owner_id], campaign) for campaign in campaigns],
+        existing=lineitems, force=True)
+
+    if not links:
+        return
+
+    creatives = creatives_service.upsert_creatives(
+        [(owners[link.author_id], link) for link in links.itervalues()])
+
+    lineitems_service.associate_with_creatives(
+        [(synced[campaign._fullname],
+          creatives[links[campaign.link_id]._fullname])
+            for campaign in missing if campaign.link_id in links])
+
+
+def reconcile_lineitems(dry_run=False):
+    """
+    Deactivates the lineitems of campaigns that no longer exist or have
+    been deleted.
+    """
+
+    counts = Counter()
+    prefix = _campaign_prefix()
+    lineitems = lineitems_service.iter_lineitems(
+        "WHERE isArchived = false ORDER BY id ASC")
+
+    for page in pql.chunks(lineitems, PAGE_SIZE):
+        by_fullname = {}
+        for lineitem in page:
+            external_id = getattr(lineitem, "externalId", None)
+
+            if external_id and external_id.startswith(prefix):
+                by_fullname[external_id] = lineitem
+
+        campaigns = PromoCampaign._by_fullname(
+            by_fullname.keys(), ignore_missing=True, return_dict=True)
+        # deleted campaigns are still returned by _by_fullname
+        orphans = [lineitem for fullname, lineitem in by_fullname.iteritems()
+                    if fullname not in campaigns or
+                        campaigns[fullname]._deleted]
+
+        counts["orphaned"] += len(orphans)
+        counts["checked"] += len(by_fullname)
+
+        if orphans and not dry_run:
+            lineitems_service.deactivate_lineitems(orphans)
+
+    return counts
+
+
+def _get_watermark(name):
+    watermark = DfpSyncState.get(name)
+
+    if watermark:
+        return datetime.strptime(watermark, WATERMARK_FORMAT)
+
+    return datetime.now(g.tz).replace(tzinfo=None) - FIRST_SYNC_WINDOW
+
+
+def _iter_modified(method, since):
+    """
+    Yields pages of the entities a `get*ByStatement` `method` returns that
+    were modified at or after `since`, oldest first.
+
+    Pages are keyed on lastModifiedDateTime rather than an offset, which
+    shifts as entities are modified during the run, and compared with `>=`
+    since it only has a resolution of a second; entities already yielded
+    at the same version are skipped.
+    """
+
+    query = ("WHERE lastModifiedDateTime >= :since "
+             "ORDER BY lastModifiedDateTime ASC")
+    seen = set()
+    offset = 0
+
+    while True:
+        values = [{
+            "key": "since",
+            "value": pql.datetime_value(since, g.dfp_timezone_id),
+        }]
+        results = pql.get_page(method, query, values, PAGE_SIZE, offset)
+
+        page = [entity for entity in results
+                    if (entity["id"], get_dfp_version(entity)) not in seen]
+        seen.update((entity["id"], get_dfp_version(entity))
+                        for entity in page)
+
+        if page:
+            yield page
+
+        if len(results) < PAGE_SIZE:
+            break
+
+        latest = datetime.strptime(
+            max(filter(None, map(get_dfp_version, results))),
+            WATERMARK_FORMAT)
+
+        if latest > since:
+            since = latest
+            offset = 0
+        else:
+            # a whole page modified in the same second
+            offset += PAGE_SIZE
+
+
+def _advance_watermark(name, entities, watermark):
+    versions = filter(None, map(get_dfp_version, entities))
+
+    if versions:
+        watermark = max(versions + [watermark])
+        DfpSyncState.set(name, watermark)
+
+    return watermark
+
+
+def _sync_changed_lineitems(repair):
+    counts = Counter()
+    name = "lineitems_modified"
+    since = _get_watermark(name)
+    watermark = since.strftime(WATERMARK_FORMAT)
+    prefix = _campaign_prefix()
+
+    for page in _iter_modified(
+            lineitems_service.dfp_lineitems_service.getLineItemsByStatement,
+            since):
+        by_fullname = {}
+        for lineitem in page:
+            external_id = getattr(lineitem, "externalId", None)
+
+            if external_id and external_id.startswith(prefix):
+                by_fullname[external_id] = lineitem
+                record_dfp_id(external_id, "lineitem", lineitem,
+                              refresh=False)
+
+        campaigns = PromoCampaign._by_fullname(
+            by_fullname.keys(), ignore_missing=True, data=True,
+            return_dict=True)
+        # deleted campaigns are reconcile_lineitems' to deactivate
+        drifted = [campaign for fullname, campaign in campaigns.iteritems()
+                    if not campaign._deleted and
+                        not lineitems_service.is_synced(
+                            campaign, by_fullname[fullname])]
+
+        counts["changed"] += len(by_fullname)
+        counts["drifted"] += len(drifted)
+
+        if drifted:
+            links = Link._byID({campaign.link_id for campaign in drifted},
+                               return_dict=True)
+
+            for campaign in drifted:
+                g.log.warning("dfp lineitem for %s has drifted" %
+                              campaign._fullname)
+
+                if repair:
+                    # other consumers may still have the stale fingerprint
+                    queue.push("upsert_campaign", {
+                        "link": links[campaign.link_id]._fullname,
+                        "campaign": campaign._fullname,
+                        "force": True,
+                    })
+
+        watermark = _advance_watermark(name, page, watermark)
+
+    return counts
+
+
+def _sync_changed_creatives(repair):
+    counts = Counter()
+    name = "creatives_modified"
+    since = _get_watermark(name)
+    watermark = since.strftime(WATERMARK_FORMAT)
+
+    for page in _iter_modified(
+            creatives_service.dfp_creatives_service.getCreativesByStatement,
+            since):
+        by_fullname = {}
+        for creative in page:
+            fullname = creatives_service.get_link_fullname(creative)
+
+            if fullname:
+                by_fullname[fullname] = creative
+                record_dfp_id(fullname, "creative", creative, refresh=False)
+
+        links = Link._by_fullname(
+            by_fullname.keys(), ignore_missing=True, data=True,
+            return_dict=True)
+        drifted = [link for fullname, link in links.iteritems()
+                    if not creatives_service.is_synced(
+                        link, by_fullname[fullname])]
+
+        counts["changed"] += len(by_fullname)
+        counts["drifted"] += len(drifted)
+
+        for link in drifted:
+            g.log.warning("dfp creative for %s has drifted" % link._fullname)
+
+            if repair:
+                queue.push("upsert_promotion", {
+                    "link": link._fullname,
+                    "force": True,
+                })
+
+        watermark = _advance_watermark(name, page, watermark)
+
+    return counts
+
+
+def sync_changes(repair=True):
+    """
+    Pulls lineitems and creatives modified since the last run into the id
+    map and flags (and with `repair`, requeues) any that have drifted
+    from reddit's copy.
+    """
+
+    lineitem_counts = _sync_changed_lineitems(repair)
+    g.log.info("dfp sync changed lineitems: %s" % dict(lineitem_counts))
+
+    creative_counts = _sync_changed_creatives(repair)
+    g.log.info("dfp sync changed creatives: %s" % dict(creative_counts))
+
+
+def run(dry_run=False):
+    campaign_counts = reconcile_campaigns(dry_run=dry_run)
+    g.log.info("dfp reconcile campaigns: %s" % dict(campaign_counts))
+
+    lineitem_counts = reconcile_lineitems(dry_run=dry_run)
+    g.log.info("dfp reconcile lineitems: %s" % dict(lineitem_counts))
@@ -1,78 +1,145 @@
-import time
+from contextlib import contextmanager
+
+from reddit_dfp.lib import (
+    errors,
+    pql,
+)
+from reddit_dfp.models.cache import AccountDfpIds
+from reddit_dfp.models.entities import Advertiser
+from reddit_dfp.services import authentication_service
 
-from googleads import dfp
-from pylons import g
-from suds import WebFault
+dfp_company_service = authentication_service.get_service("CompanyService")
 
-from reddit_dfp.lib import errors
-from reddit_dfp.services import authentication_service
+advertiser_ids = AccountDfpIds("company", "dfp_advertiser_id")
 
-MAX_RETRIES = 3
-
-dfp_client = authentication_service.get_client()
-dfp_company_service = dfp_client.GetService("CompanyService", version=g.dfp_service_version)
-
-
-def get_advertiser(user):
-    advertiser_id = getattr(user, "dfp_advertiser_id", None)
-    if not advertiser_id:
-        return None
-
-    values = [{
-        "key": "id",
-        "value": {
-            "xsi_type": "NumberValue",
-            "value": advertiser_id,
-        },
-    }]
-
-    query = "WHERE id = :id"
-    statement = dfp.FilterStatement(query, values, 1)
-    response = None
-    retries = 0
-    while response == None and retries < MAX_RETRIES:
-        try:
-            response = dfp_company_service.getCompaniesByStatement(
-                    statement.ToStatement())
-        except WebFault as e:
-            if errors.get_reason(e) == "EXCEEDED_QUOTA":
-                wait = 2 ** retries
-                print "failed attempt %d, retrying in %d seconds." % ((retries + 1), wait)
-                time.sleep(wait)
-                retries += 1
-            else:
-                raise e
 
-    if not response:
-        return None
+def get_advertisers(users):
+    """
+    Returns the companies already in DFP for `users`, keyed by fullname.
+    """
+
+    advertisers = {}
+
+    for chunk in pql.chunks([user._fullname for user in users]):
+        query = "WHERE externalId IN (%s)" % pql.text_list(chunk)
+        for company in pql.iter_results(
+                dfp_company_service.getCompaniesByStatement, query):
+            advertisers[company["externalId"]] = company
 
-    if ("results" in response and len(response["results"])):
-        return response["results"][0]
-    else:
-        return None
+    return advertisers
+
+
+def _user_to_advertiser(user):
+    return Advertiser(
+        name=user.name,
+        type="ADVERTISER",
+        external_id=user._fullname,
+    )
 
 
 def create_advertiser(user):
-    companies = [{
-        "name": user.name,
-        "type": "ADVERTISER",
-        "externalId": user._fullname,
-    }]
+    advertiser = _user_to_advertiser(user)
+    companies = dfp_company_service.createCompanies([advertiser.to_soap()])
 
-    companies = dfp_company_service.createCompanies(companies)
+    return companies[0]
 
-    advertiser = companies[0]
 
-    user.dfp_advertiser_id = advertiser["id"]
-    user._commit()
+def upsert_advertiser(user):
+    advertiser_id = advertiser_ids.get(user)
+
+    if advertiser_id:
+        return Advertiser(id=advertiser_id)
+
+    with advertiser_ids.locking([user]):
+        # another worker may have created it while we waited for the lock
+        advertiser_id = advertiser_ids.get(user, fresh=True)
+
+        if advertiser_id:
+            return Advertiser(id=advertiser_id)
+
+        # it may only have been forgotten
+        advertiser = (get_advertisers([user]).get(user._fullname) or
+            create_advertiser(user))
+        advertiser_ids.set(user, advertiser)
 
     return advertiser
 
 
-def upsert_advertiser(user):
-    advertiser = get_advertiser(user)
+def upsert_advertisers(users):
+    """
+    Batched `upsert_advertiser`; looks up the unknown advertisers in one
+    query, creates the rest in one call and returns the advertisers keyed
+    by user id.
+    """
+
+    results = {}
+    missing = []
+
+    for user in users:
+        advertiser_id = advertiser_ids.get(user)
+
+        if advertiser_id:
+            results[user._id] = Advertiser(id=advertiser_id)
+        else:
+            missing.append(user)
+
+    if not missing:
+        return results
+
+    with advertiser_ids.locking(missing):
+        # another worker may have created some while we waited for the locks
+        unresolved = []
+        for user in missing:
+            advertiser_id = advertiser_ids.get(user, fresh=True)
+
+            if advertiser_id:
+                results[user._id] = Advertiser(id=advertiser_id)
+            else:
+                unresolved.append(user)
+
+        existing = get_advertisers(unresolved)
+        missing = []
+
+        for user in unresolved:
+            advertiser = existing.get(user._fullname)
+
+            if advertiser:
+                advertiser_ids.set(user, advertiser)
+                results[user._id] = advertiser
+            else:
+                missing.append(user)
+
+        if not missing:
+            return results
+
+        companies = dfp_company_service.createCompanies(
+            [_user_to_advertiser(user).to_soap() for user in missing])
+
+        # created entities are returned in the order they were sent
+        for user, advertiser in zip(missing, companies):
+            advertiser_ids.set(user, advertiser)
+            results[user._id] = advertiser
+
+    return results
+
+
+def forget_advertiser(user):
+    advertiser_ids.forget(user)
+
+
+@contextmanager
+def forgetting_missing(users):
+    """
+    Forgets the advertisers resolved for `users` if DFP reports one of
+    them missing inside the block, so the next attempt resolves them again.
+    """
+
+    try:
+        yield
+    except Exception as e:
+        if errors.is_not_found(e):
+            for user in users:
+                forget_advertiser(user)
 
-    if advertiser:
-        return advertiser
+        raise
 
-    return create_advertiser(user)
@@ -1,21 +1,90 @@
+import tempfile
+import threading
+
 from googleads import dfp
 from googleads import oauth2
 from os import path
 from pylons import g
+from suds.cache import ObjectCache
+
+from reddit_dfp.lib.proxy import ServiceProxy
 
 
 KEY_FILE = path.join(path.dirname(path.abspath(__file__)), "../../id_dfp")
+WSDL_CACHE_DIR = path.join(tempfile.gettempdir(), "reddit_dfp_wsdl")
+WSDL_CACHE_DAYS = 7
+
+_client = None
+_lock = threading.Lock()
+_service_factory = None
+
+# suds clients aren't thread safe so each thread gets its own services
+_local = threading.local()
+
+
+def _make_client():
+    oauth2_client = oauth2.GoogleServiceAccountClient(
+        oauth2.GetAPIScope("dfp"),
+        g.dfp_service_account_email,
+        KEY_FILE,
+    )
 
-oauth2_client = oauth2.GoogleServiceAccountClient(
-    oauth2.GetAPIScope("dfp"),
-    g.dfp_service_account_email,
-    KEY_FILE,
-)
+    # parsed WSDLs are cached on disk so each process doesn't have to
+    # download and parse them again.
+    cache_dir = getattr(g, "dfp_wsdl_cache_dir", None) or WSDL_CACHE_DIR
+    cache = ObjectCache(location=cache_dir, days=WSDL_CACHE_DAYS)
 
-_client = dfp.DfpClient(oauth2_client, g.dfp_project_id)
-_client.network_code = g.dfp_network_code
+    client = dfp.DfpClient(oauth2_client, g.dfp_project_id, cache=cache)
+    client.network_code = g.dfp_network_code
+
+    return client
 
-print "code", _client.network_code
 
 def get_client():
+    global _client
+
+    if _client is None:
+        with _lock:
+            if _client is None:
+                _client = _make_client()
+
     return _client
+
+
+def set_service_factory(factory):
+    """
+    Makes every service proxy get its services from `factory(name)`
+    instead of the DFP client, e.g. to run against a fake DFP. Pass None to
+    go back to DFP.
+    """
+
+    global _service_factory
+
+    _service_factory = factory
+
+
+def _get_dfp_service(name):
+    if _service_factory is not None:
+        return _service_factory(name)
+
+    services = getattr(_local, "services", None)
+
+    if services is None:
+        services = _local.services = {}
+
+    if name not in services:
+        services[name] = get_client().GetService(
+            name, version=g.dfp_service_version)
+
+    return services[name]
+
+
+def get_service(name):
+    """
+    Returns a proxy for the `name` DFP service.
+
+    Nothing is fetched until the first call, so importing the service
+    modules is cheap for processes that never talk to DFP.
+    """
+
+    return ServiceProxy(name, _get_dfp_service)
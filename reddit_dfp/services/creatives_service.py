@@ -1,5 +1,6 @@
 # coding=utf-8
 
+from contextlib import contextmanager
 from googleads import dfp
 from pylons import g
 
@@ -8,7 +9,19 @@ from r2.models import (
     promo,
 )
 
-from reddit_dfp.lib.merge import merge_deep
+from reddit_dfp.lib import (
+    errors,
+    pql,
+)
+from reddit_dfp.lib.fingerprint import project
+from reddit_dfp.lib.merge import Template, merge_changes
+from reddit_dfp.models.cache import (
+    DfpIdsByFullname,
+    get_dfp_attr,
+    record_dfp_id,
+    set_dfp_attr,
+)
+from reddit_dfp.models.entities import Creative, TemplateVariable
 from reddit_dfp.services import (
     authentication_service,
     lineitems_service,
@@ -24,11 +37,10 @@ CREATIVE_DEFAULTS = {
     "size": NATIVE_SIZE,
     "creativeTemplateId": g.dfp_selfserve_template_id,
 }
+CREATIVE_TEMPLATE = Template(CREATIVE_DEFAULTS)
 
 
-dfp_client = authentication_service.get_client()
-dfp_creatives_service = dfp_client.GetService(
-    "CreativeService", version=g.dfp_service_version)
+dfp_creatives_service = authentication_service.get_service("CreativeService")
 
 
 def _trim(string, length):
@@ -39,57 +51,102 @@ def _get_creative_name(link):
     return "%s [%s]" % (_trim(link.title, 150), _trim(link.url, 100))
 
 
-def _link_to_creative(link, advertiser=None, existing=None):
-    if not (existing or advertiser):
-        raise ValueError("must either pass an advertiser or an existing creative.")
-
-    creative = {
-        "name": _get_creative_name(link),
-        "creativeTemplateVariableValues": [{
-            "xsi_type": "StringCreativeTemplateVariableValue",
-            "uniqueName": "title",
-            "value": link.title
-        }, {
-            "xsi_type": "UrlCreativeTemplateVariableValue",
-            "uniqueName": "url",
-            "value": link.url,
-        }, {
-            "xsi_type": "StringCreativeTemplateVariableValue",
-            "uniqueName": "selftext",
-            "value": link.selftext
-        }, {
-            "xsi_type": "StringCreativeTemplateVariableValue",
-            "uniqueName": "thumbnail_url",
-            "value": link.thumbnail_url,
-        }, {
-            "xsi_type": "StringCreativeTemplateVariableValue",
-            "uniqueName": "mobile_ad_url",
-            "value": link.mobile_ad_url,
-        }, {
-            "xsi_type": "StringCreativeTemplateVariableValue",
-            "uniqueName": "third_party_tracking",
-            "value": link.third_party_tracking,
-        }, {
-            "xsi_type": "StringCreativeTemplateVariableValue",
-            "uniqueName": "third_party_tracking_2",
-            "value": link.third_party_tracking_2,
-        }, {
-            "xsi_type": "StringCreativeTemplateVariableValue",
-            "uniqueName": "link_id",
-            "value": link._fullname,
-        }],
-    }
-
-    if existing:
-        return merge_deep(existing, creative)
-    else:
-        return merge_deep(creative, CREATIVE_DEFAULTS, {
-            "advertiserId": advertiser_id,
-        })
+def _link_to_entity(link):
+    return Creative(
+        name=_get_creative_name(link),
+        template_variables=[
+            TemplateVariable.string("title", link.title),
+            TemplateVariable.url("url", link.url),
+            TemplateVariable.string("selftext", link.selftext),
+            TemplateVariable.string("thumbnail_url", link.thumbnail_url),
+            TemplateVariable.string("mobile_ad_url", link.mobile_ad_url),
+            TemplateVariable.string(
+                "third_party_tracking", link.third_party_tracking),
+            TemplateVariable.string(
+                "third_party_tracking_2", link.third_party_tracking_2),
+            TemplateVariable.string("link_id", link._fullname),
+        ],
+    )
+
+
+def _get_fingerprint(link):
+    return _link_to_entity(link).fingerprint()
+
+
+def _get_unchanged(link, fingerprint):
+    """
+    Returns a stub of the link's creative if it was last synced with the
+    same fields, in which case there's nothing to send to DFP.
+    """
+
+    creative_id = DfpIdsByFullname.get_synced(
+        link._fullname, "creative", fingerprint)
+
+    if not creative_id:
+        return None
+
+    g.stats.simple_event("dfp.creative.unchanged")
+
+    return Creative(id=creative_id)
+
+
+def is_synced(link, creative):
+    """
+    Whether `creative`, as fetched from DFP, matches what `link` would
+    currently be synced as.
+    """
+
+    fields = _link_to_entity(link).to_soap()
+
+    return project(creative, fields) == project(fields, fields)
+
+
+def get_link_fullname(creative):
+    """
+    Returns the fullname of the link a selfserve creative was made from.
+    """
+
+    values = getattr(creative, "creativeTemplateVariableValues", None) or []
+
+    for value in values:
+        if value["uniqueName"] == "link_id":
+            return getattr(value, "value", None)
+
+    return None
+
+
+def _link_to_creative(link, advertiser):
+    creative = _link_to_entity(link).to_soap()
+
+    return CREATIVE_TEMPLATE.build(creative, {
+        "advertiserId": advertiser["id"],
+    })
+
+
+def _update_creative(link, existing):
+    """
+    Returns `existing` with the link's fields merged in, and the fields
+    that changed.
+    """
+
+    creative = _link_to_entity(link).to_soap()
+
+    return merge_changes(existing, creative)
+
+
+def get_creative_stub(link):
+    """
+    Returns a Creative with just the id of the link's creative, for callers
+    that only need to refer to it, or None if it hasn't been created.
+    """
+
+    creative_id = get_dfp_attr(link, "dfp_creative_id")
+
+    return Creative(id=creative_id) if creative_id else None
 
 
 def get_creative(link):
-    creative_id = getattr(link, "dfp_creative_id", None)
+    creative_id = get_dfp_attr(link, "dfp_creative_id")
 
     if not creative_id:
         return None
@@ -117,21 +174,195 @@ def by_id(creative_id):
         return None
 
 
+def by_ids(creative_ids):
+    creatives = {}
+
+    for chunk in pql.chunks(creative_ids):
+        query = "WHERE id IN (%s)" % pql.number_list(chunk)
+        for creative in pql.iter_results(
+                dfp_creatives_service.getCreativesByStatement, query):
+            creatives[creative["id"]] = creative
+
+    return creatives
+
+
+def iter_creatives(query, values=None):
+    return pql.iter_results(
+        dfp_creatives_service.getCreativesByStatement, query, values)
+
+
+def get_creatives(links):
+    links_by_creative_id = {}
+    for link in links:
+        creative_id = get_dfp_attr(link, "dfp_creative_id")
+        if creative_id:
+            links_by_creative_id[creative_id] = link
+
+    creatives = by_ids(links_by_creative_id.keys())
+
+    return {links_by_creative_id[creative_id]._fullname: creative
+                for creative_id, creative in creatives.iteritems()}
+
+
+def _set_creative_id(link, creative):
+    set_dfp_attr(link, "dfp_creative_id", creative["id"])
+
+    record_dfp_id(link._fullname, "creative", creative,
+                  fingerprint=_get_fingerprint(link))
+
+
+def _get_created(links):
+    """
+    Returns the creatives DFP has for `links`, keyed by link fullname.
+    They are looked up by name, so this finds creatives whose ids were
+    never recorded.
+    """
+
+    fullnames = {link._fullname for link in links}
+    creatives = {}
+
+    for chunk in pql.chunks([_get_creative_name(link) for link in links]):
+        query = "WHERE name IN (%s)" % pql.text_list(chunk)
+        for creative in iter_creatives(query):
+            fullname = get_link_fullname(creative)
+
+            if fullname in fullnames:
+                creatives[fullname] = creative
+
+    return creatives
+
+
+@contextmanager
+def _recording_created(links):
+    """
+    Records the creatives DFP did make for `links` if a create inside the
+    block fails in a way that may still have been applied, so the next
+    attempt updates them rather than creating duplicates.
+    """
+
+    try:
+        yield
+    except Exception as e:
+        if errors.is_ambiguous(e):
+            links_by_fullname = {link._fullname: link for link in links}
+
+            for fullname, creative in _get_created(links).iteritems():
+                _set_creative_id(links_by_fullname[fullname], creative)
+
+        raise
+
+
 def create_creative(user, link):
     advertiser = advertisers_service.upsert_advertiser(user)
 
-    creative = _link_to_creative(link, advertiser=advertiser)
+    creative = _link_to_creative(link, advertiser)
+    with advertisers_service.forgetting_missing([user]):
+        with _recording_created([link]):
+            creatives = dfp_creatives_service.createCreatives([creative])
+    creative = creatives[0]
+
+    _set_creative_id(link, creative)
+
+    return creative
+
 
-    return dfp_creatives_service.createCreative(creative)
+def upsert_creative(user, link, force=False):
+    link_fingerprint = _get_fingerprint(link)
+    unchanged = not force and _get_unchanged(link, link_fingerprint)
+
+    if unchanged:
+        return unchanged
 
-def upsert_creative(user, link):
     creative = get_creative(link)
 
     if not creative:
         return create_creative(user, link)
 
-    updated = _link_to_creative(link, existing=lineitem)
-    creatives = dfp_creatives_service.updateCreatives([updated])
+    updated, changes = _update_creative(link, creative)
+
+    if changes:
+        creatives = dfp_creatives_service.updateCreatives([updated])
+        creative = creatives[0]
+
+    record_dfp_id(link._fullname, "creative", creative,
+                  fingerprint=link_fingerprint)
+
+    return creative
+
+
+def upsert_creatives(pairs, force=False):
+    """
+    Batched `upsert_creative` for a list of (user, link) pairs. `force`
+    writes even links that look unchanged.
+
+    Returns the resulting creatives keyed by link fullname.
+    """
+
+    results = {}
+    fingerprints = {}
+    changed = []
+
+    for user, link in pairs:
+        link_fingerprint = _get_fingerprint(link)
+        unchanged = not force and _get_unchanged(link, link_fingerprint)
+
+        if unchanged:
+            results[link._fullname] = unchanged
+        else:
+            fingerprints[link._fullname] = link_fingerprint
+            changed.append((user, link))
+
+    if not changed:
+        return results
+
+    existing = get_creatives([link for user, link in changed])
+    advertisers = {}
+    to_create = []
+    to_update = []
+    created_links = []
+    updated_links = []
+    creating_users = []
+
+    for user, link in changed:
+        creative = existing.get(link._fullname)
+
+        if creative:
+            updated, changes = _update_creative(link, creative)
+
+            if changes:
+                to_update.append(updated)
+                updated_links.append(link)
+            else:
+                record_dfp_id(link._fullname, "creative", creative,
+                              fingerprint=fingerprints[link._fullname])
+                results[link._fullname] = creative
+        else:
+            if user._id not in advertisers:
+                advertisers[user._id] = (
+                    advertisers_service.upsert_advertiser(user))
+                creating_users.append(user)
+
+            to_create.append(_link_to_creative(
+                link, advertisers[user._id]))
+            created_links.append(link)
+
+    if to_create:
+        with advertisers_service.forgetting_missing(creating_users):
+            with _recording_created(created_links):
+                creatives = dfp_creatives_service.createCreatives(to_create)
+
+        # created entities are returned in the order they were sent
+        for link, creative in zip(created_links, creatives):
+            _set_creative_id(link, creative)
+            results[link._fullname] = creative
+
+    if to_update:
+        creatives = dfp_creatives_service.updateCreatives(to_update)
+
+        for link, creative in zip(updated_links, creatives):
+            record_dfp_id(link._fullname, "creative", creative,
+                          fingerprint=fingerprints[link._fullname])
+            results[link._fullname] = creative
 
-    return creatives[0]
+    return results
 
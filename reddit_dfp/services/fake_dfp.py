@@ -0,0 +1,412 @@
+"""
+An in-process stand-in for the parts of DFP the plugin uses.
+
+`FakeDfp` keeps companies, orders, lineitems, creatives and lineitem
+creative associations in memory and answers the PQL filters the service
+modules send. It can add latency to every call and inject quota and
+server faults, so the sync path can be exercised and measured without
+touching the real network:
+
+    fake = FakeDfp(latency=0.05, error_rate=0.01)
+    fake.install()
+    try:
+        ...
+    finally:
+        fake.uninstall()
+
+Calls still go through the service proxies, so the rate limiter and
+retries behave as they do against DFP.
+"""
+
+import random
+import re
+import threading
+import time
+
+from collections import Counter
+from datetime import datetime
+
+from suds import WebFault
+from suds.sudsobject import Factory
+
+from reddit_dfp.services import authentication_service
+
+FIRST_ID = 100000000
+
+# service name: (entity, plural used in the method names)
+SERVICES = {
+    "CompanyService": ("Company", "Companies"),
+    "OrderService": ("Order", "Orders"),
+    "LineItemService": ("LineItem", "LineItems"),
+    "CreativeService": ("Creative", "Creatives"),
+    "LineItemCreativeAssociationService": (
+        "LineItemCreativeAssociation", "LineItemCreativeAssociations"),
+}
+CREATE_DEFAULTS = {
+    "LineItem": {
+        "isArchived": False,
+        "status": "DRAFT",
+    },
+    "LineItemCreativeAssociation": {
+        "status": "ACTIVE",
+    },
+}
+
+STATEMENT_RE = re.compile(
+    r"^\s*(?:WHERE\s+(?P<where>.*?))?\s*"
+    r"(?:ORDER\s+BY\s+(?P<order>\w+)(?:\s+(?P<direction>ASC|DESC))?)?\s*"
+    r"(?:LIMIT\s+(?P<limit>\d+))?\s*(?:OFFSET\s+(?P<offset>\d+))?\s*$",
+    re.I | re.S)
+CONDITION_RE = re.compile(r"^(\w+)\s*(=|!=|>=|<=|>|<|IN)\s*(.+)$", re.I | re.S)
+LITERAL_RE = re.compile(r"'((?:[^'\\]|\\.)*)'|(-?\d+)|(true|false)", re.I)
+OPERATORS = {
+    "=": lambda a, b: a == b,
+    "!=": lambda a, b: a != b,
+    ">": lambda a, b: a is not None and a > b,
+    "<": lambda a, b: a is not None and a < b,
+    ">=": lambda a, b: a is not None and a >= b,
+    "<=": lambda a, b: a is not None and a <= b,
+    "IN": lambda a, b: a in b,
+}
+
+
+class FakeObject(dict):
+    """
+    A dict that also allows attribute access, used for the stored entities.
+    Callers get suds objects (see `_to_suds`), like the real services return.
+    """
+
+    def __getattr__(self, attr):
+        try:
+            return self[attr]
+        except KeyError:
+            raise AttributeError(attr)
+
+
+class _Fault(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def make_fault(reason):
+    """
+    Returns a WebFault shaped like an ApiException from DFP.
+    """
+
+    error = _Fault(reason=reason, errorString="FakeDfp.%s" % reason)
+    fault = _Fault(
+        faultstring="[FakeDfp.%s]" % reason,
+        detail=_Fault(ApiExceptionFault=_Fault(errors=[error])),
+    )
+
+    return WebFault(fault, None)
+
+
+def _wrap(value):
+    if isinstance(value, dict):
+        return FakeObject((key, _wrap(item)) for key, item in value.iteritems())
+    elif isinstance(value, list):
+        return [_wrap(item) for item in value]
+    elif hasattr(value, "__keylist__"):
+        # a suds object that came back from a real service
+        return FakeObject((key, _wrap(getattr(value, key)))
+                            for key in value.__keylist__)
+
+    return value
+
+
+def _to_suds(value, name="Object"):
+    if isinstance(value, dict):
+        obj = Factory.object(value.get("xsi_type") or name)
+
+        for key, item in value.iteritems():
+            if key != "xsi_type":
+                setattr(obj, key, _to_suds(item))
+
+        return obj
+    elif isinstance(value, list):
+        return [_to_suds(item, name) for item in value]
+
+    return value
+
+
+def _datetime_value(dt, timezone_id):
+    return FakeObject(
+        date=FakeObject(year=dt.year, month=dt.month, day=dt.day),
+        hour=dt.hour,
+        minute=dt.minute,
+        second=dt.second,
+        timeZoneID=timezone_id,
+    )
+
+
+def _comparable(value):
+    # DateTime values compare by their fields rather than as dicts
+    if isinstance(value, dict) and "date" in value:
+        date = value["date"]
+        return (int(date["year"]), int(date["month"]), int(date["day"]),
+                int(value.get("hour", 0)), int(value.get("minute", 0)),
+                int(value.get("second", 0)))
+
+    return value
+
+
+def _literal(match):
+    text, number, boolean = match.groups()
+
+    if text is not None:
+        return re.sub(r"\\(.)", r"\1", text)
+    elif number is not None:
+        return int(number)
+    else:
+        return boolean.lower() == "true"
+
+
+def _operand(text, values):
+    text = text.strip()
+
+    if text.startswith(":"):
+        return values[text[1:]]
+    elif text.startswith("("):
+        return [_literal(match) for match in LITERAL_RE.finditer(text)]
+
+    match = LITERAL_RE.match(text)
+    if not match:
+        raise make_fault("PQL_SYNTAX_ERROR")
+
+    return _literal(match)
+
+
+def _parse(statement):
+    """
+    Returns (conditions, order, descending, limit, offset) for a statement
+    made by `FilterStatement.ToStatement`.
+    """
+
+    match = STATEMENT_RE.match(statement["query"])
+    if not match:
+        raise make_fault("PQL_SYNTAX_ERROR")
+
+    values = {}
+    for value in statement.get("values") or []:
+        values[value["key"]] = _comparable(value["value"]["value"])
+
+    conditions = []
+    if match.group("where"):
+        for clause in re.split(r"\s+AND\s+", match.group("where"),
+                               flags=re.I):
+            condition = CONDITION_RE.match(clause.strip())
+            if not condition:
+                raise make_fault("PQL_SYNTAX_ERROR")
+
+            field, operator, operand = condition.groups()
+            conditions.append(
+                (field, OPERATORS[operator.upper()], _operand(operand, values)))
+
+    return (conditions, match.group("order"),
+            (match.group("direction") or "").upper() == "DESC",
+            int(match.group("limit") or 0) or None,
+            int(match.group("offset") or 0))
+
+
+class FakeService(object):
+    def __init__(self, dfp, name):
+        self._dfp = dfp
+        self.name = name
+        self.entity, self.plural = SERVICES[name]
+
+    def __getattr__(self, attr):
+        if attr == "get%sByStatement" % self.plural:
+            method = self._get
+        elif attr == "create%s" % self.plural:
+            method = self._create
+        elif attr == "update%s" % self.plural:
+            method = self._update
+        elif attr == "perform%sAction" % self.entity:
+            method = self._perform
+        else:
+            raise AttributeError(attr)
+
+        def _call(*args):
+            return self._dfp.call(self.name, attr, method, *args)
+
+        return _call
+
+    def _get(self, statement):
+        results, total, offset = self._dfp.select(self.entity, statement)
+
+        response = Factory.object("%sPage" % self.entity)
+        response.totalResultSetSize = total
+        response.startIndex = offset
+        if results:
+            response.results = _to_suds(results, self.entity)
+
+        return response
+
+    def _create(self, entities):
+        return _to_suds([self._dfp.create(self.entity, entity)
+                            for entity in entities], self.entity)
+
+    def _update(self, entities):
+        return _to_suds([self._dfp.update(self.entity, entity)
+                            for entity in entities], self.entity)
+
+    def _perform(self, action, statement):
+        if action["xsi_type"].startswith("Deactivate"):
+            status = "INACTIVE"
+        elif action["xsi_type"].startswith("Activate"):
+            status = "ACTIVE"
+        else:
+            raise make_fault("NOT_SUPPORTED")
+
+        response = Factory.object("UpdateResult")
+        response.numChanges = self._dfp.set_status(
+            self.entity, statement, status)
+
+        return response
+
+
+class FakeDfp(object):
+    """
+    In-memory DFP.
+
+    `latency` seconds (plus up to `jitter` more) are added to every call.
+    More than `quota` calls in a second fail with EXCEEDED_QUOTA and
+    `error_rate` of calls fail with SERVER_ERROR. `fail_next` schedules
+    specific faults. Every call is counted in `calls`.
+    """
+
+    def __init__(self, latency=0, jitter=0, quota=None, error_rate=0,
+                 timezone_id="America/New_York"):
+        self.latency = latency
+        self.jitter = jitter
+        self.quota = quota
+        self.error_rate = error_rate
+        self.timezone_id = timezone_id
+        self.calls = Counter()
+        self.faults = Counter()
+
+        self._entities = {entity: {} for entity, plural in SERVICES.values()}
+        self._services = {}
+        self._scheduled = []
+        self._next_id = FIRST_ID
+        self._window = None
+        self._window_calls = 0
+        self._lock = threading.RLock()
+
+    def install(self):
+        authentication_service.set_service_factory(self.get_service)
+
+    def uninstall(self):
+        authentication_service.set_service_factory(None)
+
+    def get_service(self, name):
+        with self._lock:
+            if name not in self._services:
+                self._services[name] = FakeService(self, name)
+
+            return self._services[name]
+
+    def fail_next(self, reason, count=1, method=None):
+        """
+        Makes the next `count` calls (to `method`, if given) fail with
+        `reason`.
+        """
+
+        with self._lock:
+            self._scheduled.extend([(method, reason)] * count)
+
+    def _get_fault(self, method):
+        for i, (scheduled_method, reason) in enumerate(self._scheduled):
+            if scheduled_method in (None, method):
+                del self._scheduled[i]
+                return reason
+
+        if self.quota:
+            window = int(time.time())
+
+            if window != self._window:
+                self._window = window
+                self._window_calls = 0
+
+            self._window_calls += 1
+            if self._window_calls > self.quota:
+                return "EXCEEDED_QUOTA"
+
+        if self.error_rate and random.random() < self.error_rate:
+            return "SERVER_ERROR"
+
+        return None
+
+    def call(self, service, method, fn, *args):
+        if self.latency or self.jitter:
+            time.sleep(self.latency + random.uniform(0, self.jitter))
+
+        with self._lock:
+            self.calls["%s.%s" % (service, method)] += 1
+            reason = self._get_fault(method)
+
+            if reason:
+                self.faults[reason] += 1
+                raise make_fault(reason)
+
+            return fn(*args)
+
+    def _now(self):
+        return _datetime_value(datetime.now(), self.timezone_id)
+
+    def _matches(self, entity_type, statement):
+        conditions, order, descending, limit, offset = _parse(statement)
+
+        matches = [entity for entity in self._entities[entity_type].values()
+                    if all(operator(_comparable(entity.get(field)), operand)
+                            for field, operator, operand in conditions)]
+
+        matches.sort(key=lambda entity: _comparable(entity.get(order or "id")),
+                     reverse=descending)
+
+        return matches, limit, offset
+
+    def select(self, entity_type, statement):
+        matches, limit, offset = self._matches(entity_type, statement)
+        end = offset + limit if limit else None
+
+        return matches[offset:end], len(matches), offset
+
+    def set_status(self, entity_type, statement, status):
+        matches, limit, offset = self._matches(entity_type, statement)
+        changes = 0
+
+        for entity in matches:
+            if entity.get("status") != status:
+                entity["status"] = status
+                entity["lastModifiedDateTime"] = self._now()
+                changes += 1
+
+        return changes
+
+    def create(self, entity_type, entity):
+        entity = _wrap(entity)
+
+        for key, value in CREATE_DEFAULTS.get(entity_type, {}).iteritems():
+            entity.setdefault(key, value)
+
+        entity["id"] = self._next_id
+        entity["lastModifiedDateTime"] = self._now()
+        self._next_id += 1
+
+        self._entities[entity_type][entity["id"]] = entity
+
+        return entity
+
+    def update(self, entity_type, entity):
+        entity = _wrap(entity)
+        entities = self._entities[entity_type]
+
+        if entity.get("id") not in entities:
+            raise make_fault("NOT_FOUND")
+
+        entity["lastModifiedDateTime"] = self._now()
+        entities[entity["id"]] = entity
+
+        return entity
@@ -1,15 +1,33 @@
+import copy
+
 from googleads import dfp
 from pylons import g
 
 from r2.models import promo
 
-from reddit_dfp.lib.merge import merge_deep
+from reddit_dfp.data import targeting
+from reddit_dfp.lib import (
+    pql,
+    tasks,
+)
+from reddit_dfp.lib.fingerprint import project
+from reddit_dfp.lib.merge import Template, merge_changes
+from reddit_dfp.models.cache import (
+    DfpIdsByFullname,
+    KnownAssociations,
+    record_dfp_id,
+)
+from reddit_dfp.models.entities import LineItem
 from reddit_dfp.services import (
     authentication_service,
     orders_service,
 )
 
 ONE_MICRO_DOLLAR = 1000000
+# campaigns run from midnight on their start date to midnight on their
+# (exclusive) end date
+START_HOUR = 0
+END_HOUR = 0
 NATIVE_SIZE = {
     "width": "1",
     "height": "1",
@@ -33,12 +51,11 @@ LINE_ITEM_DEFAULTS = {
         },
     },
 }
+LINE_ITEM_TEMPLATE = Template(LINE_ITEM_DEFAULTS)
 
-dfp_client = authentication_service.get_client()
-dfp_lineitems_service = dfp_client.GetService(
-    "LineItemService", version=g.dfp_service_version)
-dfp_lica_service = dfp_client.GetService(
-    "LineItemCreativeAssociationService", version=g.dfp_service_version)
+dfp_lineitems_service = authentication_service.get_service("LineItemService")
+dfp_lica_service = authentication_service.get_service(
+    "LineItemCreativeAssociationService")
 
 
 def _date_to_string(date, format="%d/%m/%y"):
@@ -60,21 +77,83 @@ def _get_platform(campaign):
         return "ANY"
 
 
+def _get_geo_targeting(campaign):
+    location = getattr(campaign, "location", None)
+
+    if not (location and location.country):
+        return None
+
+    location_id = targeting.get_location_id(
+        location.country, region=location.region, metro=location.metro)
+
+    if not location_id:
+        raise ValueError("no dfp location for %s (cid: %s)" %
+                (location, campaign._id))
+
+    return {
+        "targetedLocations": [{
+            "id": location_id,
+        }],
+    }
+
+
+def _get_technology_targeting(campaign):
+    mobile_os = getattr(campaign, "mobile_os", None)
+
+    if not (campaign.platform == "mobile" and mobile_os):
+        return None
+
+    operating_systems = []
+    for name in mobile_os:
+        os_id = targeting.get_os_id(name)
+
+        if not os_id:
+            raise ValueError("no dfp operating system for %s (cid: %s)" %
+                    (name, campaign._id))
+
+        operating_systems.append({
+            "id": os_id,
+        })
+
+    return {
+        "operatingSystemTargeting": {
+            "isTargeted": True,
+            "operatingSystems": operating_systems,
+        },
+    }
+
+
+def _get_targeting(campaign):
+    # existing lineitems have their targeting replaced wholesale, so this
+    # needs to include the default inventory targeting too
+    lineitem_targeting = copy.deepcopy(LINE_ITEM_DEFAULTS["targeting"])
+
+    geo_targeting = _get_geo_targeting(campaign)
+    if geo_targeting:
+        lineitem_targeting["geoTargeting"] = geo_targeting
+
+    technology_targeting = _get_technology_targeting(campaign)
+    if technology_targeting:
+        lineitem_targeting["technologyTargeting"] = technology_targeting
+
+    return lineitem_targeting
+
+
 def _get_cost_type(campaign):
     return "CPM" # everything is CPM currently
 
 
-def _date_to_dfp_datetime(date, hour, timezone_id=g.dfp_timezone_id):
+def _date_to_dfp_datetime(date, hour, timezone_id=None):
     return {
         "date": {
             "year": date.year,
             "month": date.month,
             "day": date.day,
         },
-        "hour": str(hour),
-        "minute": "0",
-        "second": "0",
-        "timeZoneID": timezone_id,
+        "hour": hour,
+        "minute": 0,
+        "second": 0,
+        "timeZoneID": timezone_id or g.dfp_timezone_id,
     }
 
 
@@ -96,31 +175,74 @@ def _dollars_to_money(dollars):
     }
 
 
-def _campaign_to_lineitem(campaign, order=None, existing=None):
-    if not (existing or order):
-        raise ValueError("must either pass an order or an existing lineitem.")
-
-    lineitem = {
-        "name": _get_campaign_name(campaign),
-        "startDateTime": _date_to_dfp_datetime(campaign.start_date),
-        "endDateTime": _date_to_dfp_datetime(campaign.end_date),
-        "lineItemType": _priority_to_lineitem_type(campaign.priority),
-        "costPerUnit": _dollars_to_money(campaign.cpm / 100),
-        "costType": _get_cost_type(campaign),
-        "targetPlatform": _get_platform(campaign),
-        "skipInventoryCheck": campaign.priority.inventory_override,
-        "primaryGoal": {
+def _campaign_to_entity(campaign):
+    return LineItem(
+        name=_get_campaign_name(campaign),
+        start_date_time=_date_to_dfp_datetime(
+            campaign.start_date, START_HOUR),
+        end_date_time=_date_to_dfp_datetime(campaign.end_date, END_HOUR),
+        line_item_type=_priority_to_lineitem_type(campaign.priority),
+        cost_per_unit=_dollars_to_money(campaign.cpm / 100),
+        cost_type=_get_cost_type(campaign),
+        target_platform=_get_platform(campaign),
+        skip_inventory_check=campaign.priority.inventory_override,
+        primary_goal={
             "units": campaign.impressions,
         },
-    }
+        targeting=_get_targeting(campaign),
+    )
 
-    if existing:
-        return merge_deep(existing, lineitem)
-    else:
-        return merge_deep(lineitem, LINE_ITEM_DEFAULTS, {
-            "orderId": order["id"],
-            "externalId": campaign._fullname,
-        })
+
+def _get_fingerprint(campaign):
+    return _campaign_to_entity(campaign).fingerprint()
+
+
+def _get_unchanged(campaign, fingerprint):
+    """
+    Returns a stub of the campaign's lineitem if it was last synced with the
+    same fields, in which case there's nothing to send to DFP.
+    """
+
+    lineitem_id = DfpIdsByFullname.get_synced(
+        campaign._fullname, "lineitem", fingerprint)
+
+    if not lineitem_id:
+        return None
+
+    g.stats.simple_event("dfp.lineitem.unchanged")
+
+    return LineItem(id=lineitem_id, external_id=campaign._fullname)
+
+
+def is_synced(campaign, lineitem):
+    """
+    Whether `lineitem`, as fetched from DFP, matches what `campaign` would
+    currently be synced as.
+    """
+
+    fields = _campaign_to_entity(campaign).to_soap()
+
+    return project(lineitem, fields) == project(fields, fields)
+
+
+def _campaign_to_lineitem(campaign, order):
+    lineitem = _campaign_to_entity(campaign).to_soap()
+
+    return LINE_ITEM_TEMPLATE.build(lineitem, {
+        "orderId": order["id"],
+        "externalId": campaign._fullname,
+    })
+
+
+def _update_lineitem(campaign, existing):
+    """
+    Returns `existing` with the campaign's fields merged in, and the fields
+    that changed.
+    """
+
+    lineitem = _campaign_to_entity(campaign).to_soap()
+
+    return merge_changes(existing, lineitem)
 
 
 def get_lineitem(campaign):
@@ -141,78 +263,223 @@ def get_lineitem(campaign):
     else:
         return None
 
-def create_lineitem(user, campaign):
-    order = orders_service.upsert_order(user)
 
-    lineitem = _campaign_to_lineitem(campaign, order=order)
-    lineitems = dfp_lineitems_service.createLineItems([lineitem])
+def get_lineitems(campaigns):
+    external_ids = [campaign._fullname for campaign in campaigns]
+    lineitems = {}
+
+    for chunk in pql.chunks(external_ids):
+        query = "WHERE externalId IN (%s)" % pql.text_list(chunk)
+        for lineitem in pql.iter_results(
+                dfp_lineitems_service.getLineItemsByStatement, query):
+            lineitems[lineitem["externalId"]] = lineitem
+
+    return lineitems
+
+
+def iter_lineitems(query, values=None):
+    return pql.iter_results(
+        dfp_lineitems_service.getLineItemsByStatement, query, values)
+
 
-    return lineitems[0]
+def create_lineitem(user, campaign, order=None):
+    order = order or orders_service.upsert_order(user)
 
-def upsert_lineitem(user, campaign):
-    lineitem = get_lineitem(campaign)
+    lineitem = _campaign_to_lineitem(campaign, order)
+    with orders_service.forgetting_missing([user]):
+        lineitems = dfp_lineitems_service.createLineItems([lineitem])
+    lineitem = lineitems[0]
+
+    record_dfp_id(campaign._fullname, "lineitem", lineitem,
+                  fingerprint=_get_fingerprint(campaign))
+
+    return lineitem
+
+def upsert_lineitem(user, campaign, force=False):
+    campaign_fingerprint = _get_fingerprint(campaign)
+    unchanged = not force and _get_unchanged(campaign, campaign_fingerprint)
+
+    if unchanged:
+        return unchanged
+
+    # the order is only needed to create the lineitem, but resolving it
+    # doesn't depend on the lookup so the two overlap
+    found = tasks.run({
+        "lineitem": (lambda: get_lineitem(campaign), ()),
+        "order": (lambda: orders_service.upsert_order(user), ()),
+    })
+    lineitem = found["lineitem"]
 
     if not lineitem:
-        return create_lineitem(user, campaign)
+        return create_lineitem(user, campaign, order=found["order"])
 
     if lineitem["isArchived"]:
         raise ValueError("cannot update archived lineitem (lid: %s, cid: %s)" %
                 (lineitem["id"], campaign._id))
 
-    updated = _campaign_to_lineitem(campaign, existing=lineitem)
-    lineitems = dfp_lineitems_service.updateLineItems([updated])
+    updated, changes = _update_lineitem(campaign, lineitem)
+
+    if changes:
+        lineitems = dfp_lineitems_service.updateLineItems([updated])
+        lineitem = lineitems[0]
+
+    record_dfp_id(campaign._fullname, "lineitem", lineitem,
+                  fingerprint=campaign_fingerprint)
 
-    return lineitems[0]
+    return lineitem
+
+
+def upsert_lineitems(pairs, existing=None, force=False):
+    """
+    Batched `upsert_lineitem` for a list of (user, campaign) pairs.
+
+    Issues a single lookup, create and update call for the whole batch and
+    returns the resulting lineitems keyed by campaign fullname. Callers that
+    already have the current lineitems can pass them as `existing` to skip
+    the lookup, and `force` writes even campaigns that look unchanged.
+    """
+
+    results = {}
+    fingerprints = {}
+    changed = []
+
+    for user, campaign in pairs:
+        campaign_fingerprint = _get_fingerprint(campaign)
+        unchanged = (not force and
+            _get_unchanged(campaign, campaign_fingerprint))
+
+        if unchanged:
+            results[campaign._fullname] = unchanged
+        else:
+            fingerprints[campaign._fullname] = campaign_fingerprint
+            changed.append((user, campaign))
+
+    if not changed:
+        return results
+
+    owners = {user._id: user for user, campaign in changed}
+    orders = None
+
+    if existing is None:
+        # as in `upsert_lineitem`, the orders are resolved alongside the
+        # lookup rather than after it
+        found = tasks.run({
+            "existing": (lambda: get_lineitems(
+                [campaign for user, campaign in changed]), ()),
+            "orders": (lambda: orders_service.upsert_orders(
+                owners.values()), ()),
+        })
+        existing = found["existing"]
+        orders = found["orders"]
+
+    missing = [(user, campaign) for user, campaign in changed
+                if campaign._fullname not in existing]
+    creating_users = {user._id: user for user, campaign in missing}.values()
+
+    if missing and orders is None:
+        orders = orders_service.upsert_orders(creating_users)
+
+    to_create = [_campaign_to_lineitem(campaign, orders[user._id])
+                    for user, campaign in missing]
+    to_update = []
+    up_to_date = []
+
+    for user, campaign in changed:
+        lineitem = existing.get(campaign._fullname)
+
+        if lineitem:
+            if lineitem["isArchived"]:
+                raise ValueError(
+                    "cannot update archived lineitem (lid: %s, cid: %s)" %
+                    (lineitem["id"], campaign._id))
+
+            updated, changes = _update_lineitem(campaign, lineitem)
+
+            if changes:
+                to_update.append(updated)
+            else:
+                up_to_date.append(lineitem)
+
+    lineitems = up_to_date
+    if to_create:
+        with orders_service.forgetting_missing(creating_users):
+            lineitems += dfp_lineitems_service.createLineItems(to_create)
+    if to_update:
+        lineitems += dfp_lineitems_service.updateLineItems(to_update)
+
+    for lineitem in lineitems:
+        fullname = lineitem["externalId"]
+        record_dfp_id(fullname, "lineitem", lineitem,
+                      fingerprint=fingerprints[fullname])
+        results[fullname] = lineitem
+
+    return results
 
 
 def associate_with_creative(lineitem, creative):
-    lineitem_id = lineitem["id"]
-    creative_id = creative["id"]
+    return associate_with_creatives([(lineitem, creative)])
 
-    values = [{
-        "key": "lineItemId",
-        "value": {
-            "xsi_type": "NumberValue",
-            "value": lineitem_id,
-        },
-    }, {
-        "key": "creativeId",
-        "value": {
-            "xsi_type": "NumberValue",
-            "value": creative_id,
-        },
-    }]
-    query = "WHERE lineItemId = :lineItemId AND creativeId = :creativeId"
-    statement = dfp.FilterStatement(query, values, 1)
 
-    response = dfp_lica_service.getLineItemCreativeAssociationsByStatement(
-                    statement.ToStatement())
+def _get_associated(pairs):
+    """
+    Returns which of a set of (lineitem id, creative id) pairs are already
+    associated in DFP.
+    """
 
-    if ("results" in response and len(response["results"])):
-        association = response["results"][0]
-    else:
-        associations = dfp_lica_service.createLineItemCreativeAssociations([{
+    associated = set()
+    lineitem_ids = {lineitem_id for lineitem_id, creative_id in pairs}
+
+    for chunk in pql.chunks(lineitem_ids):
+        chunk = set(chunk)
+        creative_ids = {creative_id for lineitem_id, creative_id in pairs
+                            if lineitem_id in chunk}
+        query = ("WHERE lineItemId IN (%s) AND creativeId IN (%s)" %
+                    (pql.number_list(chunk), pql.number_list(creative_ids)))
+
+        for association in pql.iter_results(
+                dfp_lica_service.getLineItemCreativeAssociationsByStatement,
+                query):
+            associated.add(
+                (association["lineItemId"], association["creativeId"]))
+
+    return associated & pairs
+
+
+def associate_with_creatives(pairs):
+    """
+    Makes sure every (lineitem, creative) pair in a list is associated.
+
+    Pairs already known to be associated are skipped without asking DFP.
+    The rest are looked up with a single query and the missing ones are
+    created in one call. Returns the associations that were created.
+    """
+
+    pairs = {(lineitem["id"], creative["id"]) for lineitem, creative in pairs}
+    pairs = KnownAssociations.get_unknown(pairs)
+
+    if not pairs:
+        return []
+
+    missing = pairs - _get_associated(pairs)
+    created = []
+
+    if missing:
+        created = dfp_lica_service.createLineItemCreativeAssociations([{
             "lineItemId": lineitem_id,
             "creativeId": creative_id,
-        }])
+        } for lineitem_id, creative_id in missing])
 
-        return associations[0]
+    KnownAssociations.add(pairs)
 
+    return created
 
-def deactivate(campaign):
-    lineitem = get_lineitem(campaign)
 
-    if not lineitem:
-        return True
+def deactivate_lineitems(lineitems):
+    lineitem_ids = [lineitem["id"] for lineitem in lineitems]
+    if not lineitem_ids:
+        return False
 
-    lineitem_id = lineitem["id"]
     values = [{
-        "key": "lineItemId",
-        "value": {
-            "xsi_type": "NumberValue",
-            "value": lineitem_id
-        },
-    }, {
         "key": "status",
         "value": {
             "xsi_type": "TextValue",
@@ -220,11 +487,61 @@ def deactivate(campaign):
         },
     }]
 
-    query = "WHERE lineItemId = :lineItemId AND status = :status"
-    statement = dfp.FilterStatement(query, values, 1)
+    changes = 0
+    for chunk in pql.chunks(lineitem_ids):
+        query = ("WHERE lineItemId IN (%s) AND status = :status" %
+                    pql.number_list(chunk))
+        statement = dfp.FilterStatement(query, values)
+
+        result = dfp_lica_service.performLineItemCreativeAssociationAction({
+            "xsi_type": "DeactivateLineItemCreativeAssociations",
+        }, statement.ToStatement())
 
-    response = dfp_lica_service.getLineItemCreativeAssociationsByStatement(
-            statement.ToStatement())
+        if result:
+            changes += int(result["numChanges"])
 
-    return result and int(result["numChanges"]) > 0
+    return changes > 0
+
+
+def get_lineitem_ids(campaigns):
+    """
+    Returns the lineitem ids for `campaigns` keyed by campaign fullname,
+    only querying DFP for campaigns without a known mapping.
+    """
+
+    lineitem_ids = {}
+    unknown = []
+
+    for campaign in campaigns:
+        # lineitem ids never change for a campaign, so any mapping will do
+        lineitem_id = DfpIdsByFullname.get_id(
+            campaign._fullname, "lineitem", max_age=None)
+
+        if lineitem_id:
+            lineitem_ids[campaign._fullname] = lineitem_id
+        else:
+            unknown.append(campaign)
+
+    if unknown:
+        for fullname, lineitem in get_lineitems(unknown).iteritems():
+            record_dfp_id(fullname, "lineitem", lineitem, refresh=False)
+            lineitem_ids[fullname] = lineitem["id"]
+
+    return lineitem_ids
+
+
+def deactivate_campaigns(campaigns):
+    lineitem_ids = get_lineitem_ids(campaigns)
+
+    return deactivate_lineitems(
+        [LineItem(id=lineitem_id) for lineitem_id in lineitem_ids.itervalues()])
+
+
+def deactivate(campaign):
+    lineitem_ids = get_lineitem_ids([campaign])
+
+    if not lineitem_ids:
+        return True
 
+    return deactivate_lineitems(
+        [LineItem(id=lineitem_ids[campaign._fullname])])
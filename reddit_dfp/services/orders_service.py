@@ -1,17 +1,26 @@
+from contextlib import contextmanager
+
 from googleads import dfp
 from pylons import g
 
+from reddit_dfp.lib import (
+    errors,
+    pql,
+)
+from reddit_dfp.models.cache import AccountDfpIds
+from reddit_dfp.models.entities import Order
 from reddit_dfp.services import (
     advertisers_service,
     authentication_service,
 )
 
-dfp_client = authentication_service.get_client()
-dfp_order_service = dfp_client.GetService("OrderService", version=g.dfp_service_version)
+dfp_order_service = authentication_service.get_service("OrderService")
+
+order_ids = AccountDfpIds("order", "dfp_order_id")
 
 def get_order(user):
     advertiser = advertisers_service.upsert_advertiser(user)
-    advertiser_id = advertiser.id
+    advertiser_id = advertiser["id"]
 
     if not advertiser_id:
         return None
@@ -22,6 +31,7 @@ def get_order(user):
             "xsi_type": "NumberValue",
             "value": advertiser_id,
         },
+    }, {
         "key": "traffickerId",
         "value": {
             "xsi_type": "NumberValue",
@@ -41,30 +51,145 @@ def get_order(user):
         return None
 
 
-def create_order(user):
-    advertiser_id = getattr(user, "dfp_advertiser_id", None)
+def _user_to_order(user, advertiser):
+    return Order(
+        name="%s-selfserve" % user.name,
+        advertiser_id=advertiser["id"],
+        salesperson_id=g.dfp_selfserve_salesperson_id,
+        trafficker_id=g.dfp_selfserve_trafficker_id,
+        external_order_id=user._fullname,
+    )
 
-    if not advertiser_id:
-        raise ValueError("user doesn't have a dfp advertiser account: %s" % user._id)
-
-    orders = [{
-        "name": "%s-selfserve" % user.name,
-        "advertiserId": advertiser_id,
-        "salespersonId": g.dfp_selfserve_salesperson_id,
-        "traffickerId": g.dfp_selfserve_trafficker_id,
-        "externalOrderId": user._fullname,
-    }]
 
-    orders = dfp_order_service.createOrders(orders)
+def create_order(user):
+    advertiser = advertisers_service.upsert_advertiser(user)
+    order = _user_to_order(user, advertiser)
+
+    with advertisers_service.forgetting_missing([user]):
+        orders = dfp_order_service.createOrders([order.to_soap()])
 
     return orders[0]
 
 
 def upsert_order(user):
-    order = get_order(user)
+    order_id = order_ids.get(user)
+
+    if order_id:
+        return Order(id=order_id)
+
+    with order_ids.locking([user]):
+        # another worker may have created it while we waited for the lock
+        order_id = order_ids.get(user, fresh=True)
+
+        if order_id:
+            return Order(id=order_id)
+
+        order = get_order(user)
+
+        if not order:
+            order = create_order(user)
+
+        order_ids.set(user, order)
+
+    return order
+
+
+def upsert_orders(users):
+    """
+    Batched `upsert_order`. Advertisers are resolved together, existing
+    orders are looked up in one query and the rest are created in one
+    call. Returns the orders keyed by user id.
+    """
+
+    results = {}
+    unresolved = []
+
+    for user in users:
+        order_id = order_ids.get(user)
+
+        if order_id:
+            results[user._id] = Order(id=order_id)
+        else:
+            unresolved.append(user)
+
+    if not unresolved:
+        return results
+
+    with order_ids.locking(unresolved):
+        # another worker may have created some while we waited for the locks
+        waited, unresolved = unresolved, []
+        for user in waited:
+            order_id = order_ids.get(user, fresh=True)
+
+            if order_id:
+                results[user._id] = Order(id=order_id)
+            else:
+                unresolved.append(user)
+
+        if unresolved:
+            _resolve_orders(unresolved, results)
+
+    return results
+
+
+def _resolve_orders(users, results):
+    # looks up the existing orders of `users` in one query and creates the
+    # rest in one call, adding them all to `results`
+    advertisers = advertisers_service.upsert_advertisers(users)
+    users_by_advertiser = {advertisers[user._id]["id"]: user
+                            for user in users}
+
+    values = [{
+        "key": "traffickerId",
+        "value": {
+            "xsi_type": "NumberValue",
+            "value": g.dfp_selfserve_trafficker_id,
+        },
+    }]
+    for chunk in pql.chunks(users_by_advertiser.keys()):
+        query = ("WHERE advertiserId IN (%s) AND traffickerId = :traffickerId"
+                    % pql.number_list(chunk))
+
+        for order in pql.iter_results(
+                dfp_order_service.getOrdersByStatement, query, values):
+            user = users_by_advertiser[order["advertiserId"]]
+
+            if user._id not in results:
+                order_ids.set(user, order)
+                results[user._id] = order
+
+    missing = [user for user in users if user._id not in results]
+    if not missing:
+        return
+
+    with advertisers_service.forgetting_missing(missing):
+        orders = dfp_order_service.createOrders(
+            [_user_to_order(user, advertisers[user._id]).to_soap()
+                for user in missing])
+
+    for user, order in zip(missing, orders):
+        order_ids.set(user, order)
+        results[user._id] = order
+
+
+def forget_order(user):
+    order_ids.forget(user)
+
+
+@contextmanager
+def forgetting_missing(users):
+    """
+    Forgets the orders resolved for `users` if DFP reports one of them
+    missing inside the block, so the next attempt resolves them again.
+    """
+
+    try:
+        yield
+    except Exception as e:
+        if errors.is_not_found(e):
+            for user in users:
+                forget_order(user)
 
-    if order:
-        return order
+        raise
 
-    return create_order(user)
 
@@ -0,0 +1,83 @@
+import imp
+import unittest
+
+from os import path
+
+from suds.sudsobject import Factory
+
+# loaded by path since importing the package needs a full r2 install
+merge = imp.load_source("reddit_dfp_merge", path.join(
+    path.dirname(path.abspath(__file__)), "..", "reddit_dfp", "lib",
+    "merge.py"))
+
+
+def _lineitem(units=100):
+    lineitem = Factory.object("LineItem")
+    lineitem.id = 1
+    lineitem.name = "campaign"
+    lineitem.primaryGoal = Factory.object("Goal")
+    lineitem.primaryGoal.goalType = "DAILY"
+    lineitem.primaryGoal.unitType = "IMPRESSIONS"
+    lineitem.primaryGoal.units = units
+    lineitem.startDateTime = Factory.object("DateTime")
+    lineitem.startDateTime.date = Factory.object("Date")
+    lineitem.startDateTime.date.year = 2015
+    lineitem.startDateTime.hour = 0
+    lineitem.creativePlaceholders = [Factory.object("CreativePlaceholder")]
+    lineitem.creativePlaceholders[0].size = Factory.object("Size")
+    lineitem.creativePlaceholders[0].size.width = 1
+
+    return lineitem
+
+
+class MergeChangesTest(unittest.TestCase):
+    def test_unchanged_suds_object(self):
+        existing = _lineitem()
+        fields = {
+            "name": "campaign",
+            "primaryGoal": {"units": 100},
+            "startDateTime": {
+                "xsi_type": "DateTime",
+                "date": {"year": 2015},
+                "hour": 0,
+            },
+            "creativePlaceholders": [{"size": {"width": 1}}],
+        }
+
+        result, changes = merge.merge_changes(existing, fields)
+
+        self.assertEqual(changes, [])
+
+    def test_merges_into_suds_object(self):
+        existing = _lineitem()
+
+        result, changes = merge.merge_changes(
+            existing, {"primaryGoal": {"units": 200}})
+
+        self.assertEqual(changes, [("primaryGoal", "units")])
+        self.assertEqual(result.primaryGoal.units, 200)
+        self.assertEqual(result.primaryGoal.goalType, "DAILY")
+        self.assertEqual(result.primaryGoal.unitType, "IMPRESSIONS")
+        self.assertEqual(result.id, 1)
+
+        # the original is left alone
+        self.assertEqual(existing.primaryGoal.units, 100)
+
+    def test_merges_suds_object_into_itself(self):
+        existing = _lineitem()
+
+        result, changes = merge.merge_changes(existing, _lineitem())
+
+        self.assertEqual(changes, [])
+        self.assertEqual(result.primaryGoal.goalType, "DAILY")
+
+    def test_template_defaults_first(self):
+        template = merge.Template({"primaryGoal": {"units": 0, "unitType": "X"}})
+
+        built = template.build({"primaryGoal": {"units": 5}})
+
+        self.assertEqual(built["primaryGoal"], {"units": 5, "unitType": "X"})
+
+
+if __name__ == "__main__":
+    unittest.main()